@@ -0,0 +1,113 @@
+"""Per-row cost of encoding /messages/ and /chats responses.
+
+Compares the default path (pydantic models, response_model validation,
+stdlib json) with FAST_JSON (plain dicts encoded by orjson) on messages
+built from real Telethon objects, without any network access:
+
+    python benchmark_serialization.py [rows]
+"""
+import asyncio
+import sys
+import time
+from datetime import datetime, timezone
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_model_field
+from telethon._updates import EntityCache
+from telethon.tl import types
+
+import telegram_api_server_stateless_json as fast_json
+from telegram_api_server_stateless import ChatsResponse, MessagesResponse, messages_json_response
+from telegram_api_server_stateless_models import MESSAGE_FIELDS, build_chat_info, build_message_fields, build_message_info
+
+
+class _OfflineClient:
+    """Just enough of TelegramClient for Message._finish_init"""
+    _self_id = 1
+    parse_mode = None
+
+    def __init__(self):
+        self._mb_entity_cache = EntityCache()
+
+
+def make_messages(count: int) -> list:
+    client = _OfflineClient()
+    users = {user_id: types.User(user_id, first_name=f"User {user_id}", last_name="Test", username=f"user{user_id}")
+             for user_id in range(100, 110)}
+    messages = []
+    for message_id in range(count, 0, -1):
+        message = types.Message(
+            id=message_id,
+            peer_id=types.PeerChannel(1000),
+            date=datetime.now(timezone.utc),
+            message=f"Message number {message_id} with some text to encode",
+            from_id=types.PeerUser(100 + message_id % 10),
+        )
+        message._finish_init(client, users, None)
+        messages.append(message)
+    return messages
+
+
+def make_chats(count: int) -> list:
+    return [
+        build_chat_info(types.User(chat_id, first_name=f"Chat {chat_id}", username=f"chat{chat_id}"), f"Chat {chat_id}")
+        for chat_id in range(1, count + 1)
+    ]
+
+
+def default_messages(messages: list) -> bytes:
+    messages_list = [build_message_info(msg) for msg in messages]
+    response = MessagesResponse(messages=messages_list, total_count=len(messages_list),
+                                has_more=False, next_offset=None)
+    content = asyncio.run(serialize_response(field=_MESSAGES_FIELD, response_content=response))
+    return JSONResponse(content).body
+
+
+def fast_messages(messages: list) -> bytes:
+    rows = [build_message_fields(msg, MESSAGE_FIELDS) for msg in messages]
+    return messages_json_response(rows, False, None).body
+
+
+def default_chats(chats: list) -> bytes:
+    response = ChatsResponse(chats=chats, total_count=len(chats))
+    content = asyncio.run(serialize_response(field=_CHATS_FIELD, response_content=response))
+    return JSONResponse(content).body
+
+
+def fast_chats(chats: list) -> bytes:
+    return fast_json.FastJSONResponse({"chats": chats, "total_count": len(chats), "next_cursor": None}).body
+
+
+_MESSAGES_FIELD = create_model_field("response", MessagesResponse)
+_CHATS_FIELD = create_model_field("response", ChatsResponse)
+
+
+def per_row_us(function, rows: list, repeat: int = 20) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(rows)
+        best = min(best, time.perf_counter() - start)
+    return best / len(rows) * 1e6
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    messages = make_messages(count)
+    chats = make_chats(count)
+
+    fast_json.FAST_JSON = True
+    if fast_json.orjson is None:
+        print("orjson is not installed, FAST_JSON falls back to pydantic-core")
+
+    print(f"{'':10} {'default':>12} {'FAST_JSON':>12}   ({count} rows, microseconds per row)")
+    for name, default, fast, rows in (
+            ("messages", default_messages, fast_messages, messages),
+            ("chats", default_chats, fast_chats, chats),
+    ):
+        print(f"{name:10} {per_row_us(default, rows):12.2f} {per_row_us(fast, rows):12.2f}")
+
+
+if __name__ == "__main__":
+    main()
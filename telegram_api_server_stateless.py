@@ -1,30 +1,74 @@
 import asyncio
-import os
+import base64
+import json
+from contextlib import nullcontext
 from datetime import datetime
-from typing import Optional, List
+from typing import Literal, Optional, List
 
-from fastapi import FastAPI, HTTPException, Header
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, HTTPException, Header, Query, Request, Response
+from fastapi.exception_handlers import http_exception_handler
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from telethon import TelegramClient
 from telethon.errors import FloodWaitError
-from telethon.sessions import StringSession
-from telethon.tl.types import Channel, Chat, User, InputPeerChannel, InputPeerChat
+from telethon.utils import get_peer_id
 
 # В начале файла, где остальные импорты:
+from telegram_api_server_stateless_auth import pending_auth, pending_clients
+from telegram_api_server_stateless_cluster import SessionAffinityMiddleware, cluster_router
+from telegram_api_server_stateless_dialogs import CHAT_TYPES, dialog_cache
 from telegram_api_server_stateless_groups import router as groups_router
+from telegram_api_server_stateless_etag import etag_matches, make_etag, not_modified
+from telegram_api_server_stateless_json import FAST_JSON, FastJSONResponse, dumps, message_payload
+from telegram_api_server_stateless_media import (
+    content_disposition,
+    iter_media,
+    media_cache,
+    media_cache_key,
+    media_file_info,
+    parse_range
+)
 from telegram_api_server_stateless_messages import router as messages_router
+from telegram_api_server_stateless_updates import get_changes, router as updates_router
+from telegram_api_server_stateless_models import (
+    MESSAGE_FIELDS,
+    SENDER_FIELDS,
+    ChangesResponse,
+    ChatInfo,
+    MessageInfo,
+    build_message_fields,
+    build_message_info,
+    parse_message_fields
+)
+from telegram_api_server_stateless_peers import normalize_chat_key, peer_cache, resolve_peer
+from telegram_api_server_stateless_ratelimit import flood_wait_error, rate_limiter
+from telegram_api_server_stateless_scheduler import SCHEDULER_BULK_PAGE_SIZE, bulk_priority, scheduler
+from telegram_api_server_stateless_sessions import session_registry
+from telegram_api_server_stateless_store import as_utc, message_store
+from telegram_api_server_stateless_uploads import upload_cache
 from telegram_api_server_stateless_utils import (
     get_client_from_session,
     encode_session_with_credentials,
     clients,
-    decode_session_with_credentials
+    decode_session_with_credentials,
+    pinned_stream,
+    safe_disconnect,
+    session_fingerprint
 )
 
 # После создания приложения (после строки app = FastAPI()):
 app = FastAPI()
 app.include_router(groups_router)
 app.include_router(messages_router)
+app.include_router(updates_router)
+if cluster_router is not None:
+    # Several workers: each session is served by the worker owning it
+    app.add_middleware(SessionAffinityMiddleware, router=cluster_router)
+
+
+@app.exception_handler(FloodWaitError)
+async def flood_wait_handler(request: Request, e: FloodWaitError):
+    """Flood waits not handled by an endpoint, e.g. raised at once for a session still blocked"""
+    return await http_exception_handler(request, flood_wait_error(e))
 
 
 class ApiCredentials(BaseModel):
@@ -47,65 +91,63 @@ class AuthResponse(BaseModel):
     session_string: Optional[str] = None
 
 
-class ChatInfo(BaseModel):
-    name: str
-    id: int
-    type: str
-    members_count: Optional[int] = None
-    is_private: bool
-    username: Optional[str] = None
-
-
 class ChatsResponse(BaseModel):
     chats: List[ChatInfo]
+    # Number of chats matching the filter, across all pages
     total_count: int
+    next_cursor: Optional[str] = None
 
 
 @app.post("/auth/send_code", response_model=AuthResponse)
 async def send_code(credentials: ApiCredentials):
     try:
-        # Create new client with provided credentials
-        client = TelegramClient(StringSession(), credentials.api_id, credentials.api_hash)
-        await client.connect()
-
-        # Send authentication code
-        await client.send_code_request(credentials.phone)
-
-        # Get session and combine with encrypted credentials
-        temp_session = client.session.save()
-        combined_session = encode_session_with_credentials(
-            temp_session,
-            credentials.api_id,
-            credentials.api_hash
+        # Connect a client for the sign-in, or reuse the pending one of this phone
+        combined_session = await pending_clients.send_code(
+            credentials.phone, credentials.api_id, credentials.api_hash
         )
 
-        # Store client
-        clients[combined_session] = client
-
         return AuthResponse(
             message="Verification code sent",
             next_step="verify_code",
             session_string=combined_session
         )
+    except HTTPException:
+        raise
+    except FloodWaitError as e:
+        raise flood_wait_error(e)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 
+async def keep_signed_in_client(session_string: str, client):
+    """Pool the client of a finished sign-in, unless its session belongs to another worker.
+
+    The sign-in ran on the worker that sent the code; the final session
+    may hash to a different one, which connects it on first use.
+    """
+    if cluster_router is None or cluster_router.serves(session_string):
+        clients[session_string] = client
+    else:
+        await safe_disconnect(client)
+
+
 @app.post("/auth/verify_code", response_model=AuthResponse)
 async def verify_code(
         verification_data: VerificationCode,
         session_string: str = Header(..., alias="X-Session-String")
 ):
     try:
-        if session_string not in clients:
-            raise HTTPException(status_code=401, detail="Invalid session")
-
-        client = clients[session_string]
+        pending = await pending_auth.get(session_string)
+        client = await pending_clients.get_or_connect(session_string)
+        if pending is None or client is None:
+            raise HTTPException(status_code=401, detail="Invalid or expired session")
         session, api_id, api_hash = decode_session_with_credentials(session_string)
 
         try:
             # Try to sign in with the code
-            await client.sign_in(code=verification_data.code)
+            await client.sign_in(
+                phone=pending.phone, code=verification_data.code, phone_code_hash=pending.phone_code_hash
+            )
 
             # Get new session and combine with credentials
             new_session = client.session.save()
@@ -115,9 +157,9 @@ async def verify_code(
                 api_hash
             )
 
-            # Update clients dictionary
-            clients[new_combined_session] = client
-            del clients[session_string]
+            client.session_key = session_fingerprint(new_combined_session)
+            pending_clients.complete(session_string)
+            await keep_signed_in_client(new_combined_session, client)
 
             return AuthResponse(
                 message="Successfully authenticated",
@@ -133,6 +175,10 @@ async def verify_code(
                 )
             raise e
 
+    except HTTPException:
+        raise
+    except FloodWaitError as e:
+        raise flood_wait_error(e)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -143,10 +189,9 @@ async def verify_password(
         session_string: str = Header(..., alias="X-Session-String")
 ):
     try:
-        if session_string not in clients:
-            raise HTTPException(status_code=401, detail="Invalid session")
-
-        client = clients[session_string]
+        client = await pending_clients.get_or_connect(session_string)
+        if client is None:
+            raise HTTPException(status_code=401, detail="Invalid or expired session")
         session, api_id, api_hash = decode_session_with_credentials(session_string)
 
         # Sign in with password
@@ -160,15 +205,19 @@ async def verify_password(
             api_hash
         )
 
-        # Update clients dictionary
-        clients[new_combined_session] = client
-        del clients[session_string]
+        client.session_key = session_fingerprint(new_combined_session)
+        pending_clients.complete(session_string)
+        await keep_signed_in_client(new_combined_session, client)
 
         return AuthResponse(
             message="Successfully authenticated with 2FA",
             next_step="completed",
             session_string=new_combined_session
         )
+    except HTTPException:
+        raise
+    except FloodWaitError as e:
+        raise flood_wait_error(e)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -176,43 +225,76 @@ async def verify_password(
 @app.get("/chats", response_model=ChatsResponse)
 async def get_chats(
         limit: int = 100,
+        cursor: Optional[str] = None,
+        type: Optional[List[str]] = Query(None),
+        refresh: bool = False,
+        response: Response = None,
+        if_none_match: Optional[str] = Header(None),
         session_string: str = Header(..., alias="X-Session-String")
 ):
+    """Chats of the account, served from a dialog snapshot kept current by updates.
+
+    Pass next_cursor of the response as cursor to get the next page,
+    refresh=true fetches the dialogs from Telegram again. Answers 304 when
+    If-None-Match has the ETag of an unchanged page.
+    """
     try:
-        client = await get_client_from_session(session_string)
+        chat_types = set(type or ())
+        unknown = chat_types - set(CHAT_TYPES)
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown chat types: {', '.join(sorted(unknown))}")
 
-        # Get dialogs
-        dialogs = await client.get_dialogs(limit=limit)
-
-        chats_list = []
-        for dialog in dialogs:
-            entity = dialog.entity
-
-            # Determine chat type
-            if isinstance(entity, Channel):
-                chat_type = "channel" if entity.broadcast else "supergroup"
-            elif isinstance(entity, Chat):
-                chat_type = "group"
-            elif isinstance(entity, User):
-                chat_type = "private"
-            else:
-                continue
-
-            chat_info = ChatInfo(
-                name=dialog.name,
-                id=dialog.id,
-                type=chat_type,
-                members_count=getattr(entity, 'participants_count', None),
-                is_private=not hasattr(entity, 'username') or entity.username is None,
-                username=getattr(entity, 'username', None)
+        client = await get_client_from_session(session_string)
+        snapshot = await dialog_cache.get(client, refresh=refresh)
+        etag = make_etag((snapshot.snapshot_id, snapshot.version, limit, cursor, sorted(chat_types)))
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
+
+        chats_list, total_count, next_cursor = snapshot.page(limit, cursor, chat_types)
+        if FAST_JSON:
+            return FastJSONResponse(
+                {"chats": chats_list, "total_count": total_count, "next_cursor": next_cursor},
+                headers={"ETag": etag}
             )
-
-            chats_list.append(chat_info)
-
+        response.headers["ETag"] = etag
         return ChatsResponse(
             chats=chats_list,
-            total_count=len(chats_list)
+            total_count=total_count,
+            next_cursor=next_cursor
         )
+    except HTTPException:
+        raise
+    except FloodWaitError as e:
+        raise flood_wait_error(e)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/chats/search", response_model=ChatsResponse)
+async def search_chats(
+        q: str,
+        limit: int = 20,
+        type: Optional[List[str]] = Query(None),
+        session_string: str = Header(..., alias="X-Session-String")
+):
+    """Find chats by words of their name or username prefix, without asking Telegram"""
+    try:
+        chat_types = set(type or ())
+        unknown = chat_types - set(CHAT_TYPES)
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown chat types: {', '.join(sorted(unknown))}")
+
+        client = await get_client_from_session(session_string)
+        snapshot = await dialog_cache.get(client)
+        chats_list, total_count = snapshot.search(q, limit, chat_types)
+
+        if FAST_JSON:
+            return FastJSONResponse({"chats": chats_list, "total_count": total_count, "next_cursor": None})
+        return ChatsResponse(chats=chats_list, total_count=total_count)
+    except HTTPException:
+        raise
+    except FloodWaitError as e:
+        raise flood_wait_error(e)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -225,33 +307,66 @@ async def logout(session_string: str = Header(..., alias="X-Session-String")):
             await client.log_out()
             await client.disconnect()
             del clients[session_string]
+        await session_registry.forget(session_string)
 
         return {"message": "Successfully logged out"}
+    except FloodWaitError as e:
+        raise flood_wait_error(e)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 
-@app.on_event("shutdown")
-async def shutdown_event():
-    # Disconnect all active clients when server stops
-    for client in clients.values():
-        try:
-            await client.disconnect()
-        except Exception:
-            pass
+@app.on_event("startup")
+async def startup_event():
+    # Periodically disconnect clients that stayed idle for too long
+    clients.start_reaper()
+    # Ping idle clients and reconnect dead ones before a request needs them
+    clients.start_health_monitor()
+    # Disconnect clients of sign-ins that were never finished
+    pending_clients.start_reaper()
+    # Reconnect the busiest sessions of the last run; in a cluster only those this worker owns
+    session_registry.start(clients, owns=cluster_router.owns if cluster_router is not None else None)
 
 
-class MessageInfo(BaseModel):
-    id: int
-    text: Optional[str]
-    date: datetime
-    sender_id: Optional[int]
-    sender_username: Optional[str]
-    sender_name: Optional[str]
-    reply_to_msg_id: Optional[int] = None
-    forward_from: Optional[str] = None
-    media_type: Optional[str] = None
-    is_pinned: Optional[bool] = False
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Remember active sessions, then disconnect all clients in parallel
+    await session_registry.close(clients)
+    await asyncio.gather(clients.close(), pending_clients.close())
+    peer_cache.close()
+    message_store.close()
+    pending_auth.close()
+    if cluster_router is not None:
+        await cluster_router.close()
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Internal counters of the server"""
+    return {
+        "client_pool": clients.stats(),
+        "peer_cache": peer_cache.stats(),
+        "rate_limiter": rate_limiter.stats(),
+        "scheduler": scheduler.stats(),
+        "media_cache": media_cache.stats(),
+        "upload_cache": upload_cache.stats(),
+        "message_store": message_store.stats(),
+        "dialog_cache": dialog_cache.stats(),
+        "pending_auth": dict(pending_auth.stats(), clients=pending_clients.stats()),
+        "session_registry": session_registry.stats(),
+        "cluster": cluster_router.stats() if cluster_router is not None else None
+    }
+
+
+@app.get("/metrics/clients")
+async def get_client_metrics():
+    """Connection age, idle time and reconnect count of every pooled client"""
+    return {"clients": clients.health()}
+
+
+class ExportRecord(BaseModel):
+    message: MessageInfo
+    cursor: str
 
 
 class MessagesResponse(BaseModel):
@@ -261,11 +376,23 @@ class MessagesResponse(BaseModel):
     next_offset: Optional[int]
 
 
+def messages_json_response(messages: list, has_more: bool, next_offset: Optional[int],
+                           etag: Optional[str] = None) -> FastJSONResponse:
+    """MessagesResponse built from dicts or models without validating it again"""
+    return FastJSONResponse({
+        "messages": messages,
+        "total_count": len(messages),
+        "has_more": has_more,
+        "next_offset": next_offset
+    }, headers={"ETag": etag} if etag else None)
+
+
 @app.get("/messages/media/{message_id}")
 async def get_media_content(
         message_id: int,
         chat_id: str,
-        session_string: str = Header(..., alias="X-Session-String")
+        session_string: str = Header(..., alias="X-Session-String"),
+        range_header: Optional[str] = Header(None, alias="Range")
 ):
     try:
         client = await get_client_from_session(session_string)
@@ -274,29 +401,9 @@ async def get_media_content(
             raise HTTPException(status_code=401, detail="Authentication required")
 
         try:
-            # Преобразуем chat_id в число, если это возможно
-            numeric_id = int(chat_id)
-
-            # Определяем тип чата по ID
-            if numeric_id < 0:
-                # Для супергрупп и каналов ID начинается с -100
-                if str(numeric_id).startswith('-100'):
-                    # Убираем -100 из ID
-                    channel_id = int(str(abs(numeric_id))[3:])
-                    entity = InputPeerChannel(channel_id=channel_id, access_hash=0)
-                else:
-                    # Для обычных групп просто используем ID
-                    entity = InputPeerChat(chat_id=abs(numeric_id))
-            else:
-                # Для пользователей и других типов пытаемся получить напрямую
-                entity = await client.get_input_entity(numeric_id)
-        except ValueError:
-            # Если не получилось преобразовать в число или найти по ID,
-            # пробуем получить по username
-            try:
-                entity = await client.get_input_entity(chat_id)
-            except ValueError as e:
-                raise HTTPException(status_code=404, detail=f"Chat not found: {str(e)}")
+            entity = await resolve_peer(client, chat_id)
+        except ValueError as e:
+            raise HTTPException(status_code=404, detail=f"Chat not found: {str(e)}")
 
         # Получаем сообщение
         message = await client.get_messages(entity, ids=message_id)
@@ -306,55 +413,53 @@ async def get_media_content(
         if not message.media:
             raise HTTPException(status_code=400, detail="Message has no media content")
 
-        # Создаем временную директорию, если её нет
-        os.makedirs("temp_downloads", exist_ok=True)
+        if not (message.photo or message.document):
+            raise HTTPException(status_code=400, detail="Failed to download media")
 
-        # Скачиваем файл
-        path = await message.download_media(file="temp_downloads/")
+        content_type, filename, size = media_file_info(message)
 
-        if not path:
-            raise HTTPException(status_code=400, detail="Failed to download media")
+        # Популярные файлы отдаем из локального кэша (Range обрабатывает FileResponse)
+        cache_key = media_cache_key(message)
+        if cache_key and media_cache.accepts(size):
+            return await media_cache.file_response(
+                cache_key, lambda: pinned_stream(session_string, iter_media(client, message)),
+                media_type=content_type, filename=filename
+            )
+
+        byte_range = parse_range(range_header, size)
+
+        # Отдаем файл частями прямо из Telegram, без временных файлов
+        headers = {
+            "Accept-Ranges": "bytes",
+            "Content-Disposition": content_disposition(filename)
+        }
+        if byte_range is None:
+            if size is not None:
+                headers["Content-Length"] = str(size)
+            return StreamingResponse(
+                pinned_stream(session_string, iter_media(client, message)),
+                media_type=content_type,
+                headers=headers
+            )
 
-        # Определяем тип контента
-        content_type = "application/octet-stream"
-        filename = os.path.basename(path)
-
-        if message.photo:
-            content_type = "image/jpeg"
-            if not filename.endswith('.jpg'):
-                filename += '.jpg'
-        elif message.video:
-            content_type = "video/mp4"
-            if not filename.endswith('.mp4'):
-                filename += '.mp4'
-        elif message.document:
-            if message.document.mime_type:
-                content_type = message.document.mime_type
-            if message.file and message.file.name:
-                filename = message.file.name
-
-        # Возвращаем файл и удаляем его после отправки
-        return FileResponse(
-            path=path,
+        start, end = byte_range
+        headers["Content-Length"] = str(end - start + 1)
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        return StreamingResponse(
+            pinned_stream(session_string, iter_media(client, message, start, end)),
+            status_code=206,
             media_type=content_type,
-            filename=filename,
-            background=asyncio.create_task(cleanup_file(path))
+            headers=headers
         )
 
+    except HTTPException:
+        raise
+    except FloodWaitError as e:
+        raise flood_wait_error(e)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 
-async def cleanup_file(path: str):
-    """Удаляет временный файл после отправки"""
-    await asyncio.sleep(1)  # Даем время на отправку файла
-    try:
-        os.remove(path)
-    except:
-
-        pass
-
-
 @app.get("/messages/", response_model=MessagesResponse)
 async def get_messages(
         chat_id: str,
@@ -363,42 +468,64 @@ async def get_messages(
         search: Optional[str] = None,
         from_date: Optional[datetime] = None,
         to_date: Optional[datetime] = None,
+        fields: Optional[str] = None,
+        response: Response = None,
+        if_none_match: Optional[str] = Header(None),
         session_string: str = Header(..., alias="X-Session-String")
 ):
+    """Messages of a chat, newest first.
+
+    fields is a comma separated list of MessageInfo fields to return, e.g.
+    fields=id,date,text; other fields are not computed at all. Answers 304
+    when If-None-Match has the ETag of an unchanged page.
+    """
     try:
+        try:
+            selected_fields = parse_message_fields(fields)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
         client = await get_client_from_session(session_string)
 
         if not await client.is_user_authorized():
             raise HTTPException(status_code=401, detail="Authentication required")
 
         try:
-            # Преобразуем chat_id в число, если это возможно
-            numeric_id = int(chat_id)
-
-            # Определяем тип чата по ID
-            if numeric_id < 0:
-                # Для супергрупп и каналов ID начинается с -100
-                if str(numeric_id).startswith('-100'):
-                    # Убираем -100 из ID
-                    channel_id = int(str(abs(numeric_id))[3:])
-                    entity = InputPeerChannel(channel_id=channel_id, access_hash=0)
-                else:
-                    # Для обычных групп просто используем ID
-                    entity = InputPeerChat(chat_id=abs(numeric_id))
-            else:
-                # Для пользователей и других типов пытаемся получить напрямую
-                entity = await client.get_input_entity(numeric_id)
-        except ValueError:
-            # Если не получилось преобразовать в число или найти по ID,
-            # пробуем получить по username
-            try:
-                entity = await client.get_input_entity(chat_id)
-            except ValueError as e:
-                raise HTTPException(status_code=404, detail=f"Chat not found: {str(e)}")
+            entity = await resolve_peer(client, chat_id)
+        except ValueError as e:
+            raise HTTPException(status_code=404, detail=f"Chat not found: {str(e)}")
+
+        # Everything except the messages themselves that the response depends on
+        request_key = (get_peer_id(entity), limit, offset_id, search, from_date, to_date, selected_fields)
 
         try:
-            # Добавляем задержку перед запросом сообщений
-            await asyncio.sleep(2)
+            # Отвечаем из локального хранилища, если нужный диапазон уже загружен
+            if message_store.enabled:
+                stored = await message_store.read(
+                    client, entity, limit, offset_id, search, from_date, to_date, raw=True
+                )
+                if stored is not None:
+                    # Stored JSON changes with every edit, so it is hashed before parsing
+                    etag = make_etag(("store", *request_key, *stored))
+                    if etag_matches(if_none_match, etag):
+                        return not_modified(etag)
+                    stored = [MessageInfo.model_validate_json(data) for data in stored]
+                    has_more = len(stored) == limit
+                    next_offset = stored[-1].id if has_more else None
+                    if selected_fields is not None:
+                        return messages_json_response(
+                            [info.model_dump(include=set(selected_fields)) for info in stored],
+                            has_more, next_offset, etag
+                        )
+                    if FAST_JSON:
+                        return messages_json_response(stored, has_more, next_offset, etag)
+                    response.headers["ETag"] = etag
+                    return MessagesResponse(
+                        messages=stored,
+                        total_count=len(stored),
+                        has_more=has_more,
+                        next_offset=next_offset
+                    )
 
             # Формируем параметры запроса
             kwargs = {
@@ -410,66 +537,57 @@ async def get_messages(
             if search:
                 kwargs["search"] = search
 
-            if from_date:
-                kwargs["min_date"] = from_date
+            # Telegram умеет только "сообщения до даты", from_date фильтруем сами
             if to_date:
-                kwargs["max_date"] = to_date
-
-            messages = await client.get_messages(entity, **kwargs)
-
-            messages_list = []
-            for msg in messages:
-                media_type = None
-                if msg.photo:
-                    media_type = "photo"
-                elif msg.video:
-                    media_type = "video"
-                elif msg.document:
-                    media_type = "document"
-                elif msg.voice:
-                    media_type = "voice"
-                elif msg.audio:
-                    media_type = "audio"
-
-                sender_id = None
-                sender_username = None
-                sender_name = None
-
-                if msg.sender:
-                    sender_id = msg.sender.id
-                    sender_username = getattr(msg.sender, 'username', None)
-                    sender_name = msg.sender.first_name
-                    if hasattr(msg.sender, 'last_name') and msg.sender.last_name:
-                        sender_name += f" {msg.sender.last_name}"
-
-                forward_from = None
-                if msg.forward:
-                    if msg.forward.from_name:
-                        forward_from = msg.forward.from_name
-                    elif msg.forward.sender:
-                        forward_from = getattr(msg.forward.sender, 'username', None) or \
-                                       msg.forward.sender.first_name
-
-                message_info = MessageInfo(
-                    id=msg.id,
-                    text=msg.text if msg.text else None,
-                    date=msg.date,
-                    sender_id=sender_id,
-                    sender_username=sender_username,
-                    sender_name=sender_name,
-                    reply_to_msg_id=msg.reply_to_msg_id,
-                    forward_from=forward_from,
-                    media_type=media_type,
-                    is_pinned=msg.pinned
-                )
-                messages_list.append(message_info)
-
-                if len(messages_list) % 20 == 0:
-                    await asyncio.sleep(1)
+                kwargs["offset_date"] = to_date
+
+            # Large pages take several requests and are scheduled like other bulk work
+            with bulk_priority() if limit > SCHEDULER_BULK_PAGE_SIZE else nullcontext():
+                messages = await client.get_messages(entity, **kwargs)
+            # Senders are only looked at when a sender field is requested
+            with_sender = selected_fields is None or not SENDER_FIELDS.isdisjoint(selected_fields)
+            peer_cache.remember_entities(
+                client.session_key,
+                (peer for msg in messages for peer in ((msg.sender, msg.chat) if with_sender else (msg.chat,)))
+            )
 
             has_more = len(messages) == limit
             next_offset = messages[-1].id if has_more and messages else None
+            if from_date:
+                from_date = as_utc(from_date)
+                has_more = has_more and bool(messages) and messages[-1].date >= from_date
+                next_offset = next_offset if has_more else None
+                messages = [msg for msg in messages if msg.date >= from_date]
+
+            # Id and edit date identify the content of a message without building it
+            etag = make_etag((
+                "live", *request_key, has_more,
+                *((msg.id, msg.edit_date, msg.pinned) for msg in messages)
+            ))
+            if etag_matches(if_none_match, etag):
+                return not_modified(etag)
+
+            save_page = message_store.enabled and not (search or from_date or to_date)
+            if selected_fields is not None:
+                return messages_json_response(
+                    [build_message_fields(msg, selected_fields) for msg in messages], has_more, next_offset, etag
+                )
+            if FAST_JSON:
+                rows = [build_message_fields(msg, MESSAGE_FIELDS) for msg in messages]
+                if save_page:
+                    await message_store.save_page(
+                        client.session_key, get_peer_id(entity),
+                        [MessageInfo.model_construct(**row) for row in rows], offset_id, len(messages) < limit
+                    )
+                return messages_json_response(rows, has_more, next_offset, etag)
+
+            messages_list = [build_message_info(msg) for msg in messages]
+            if save_page:
+                await message_store.save_page(
+                    client.session_key, get_peer_id(entity), messages_list, offset_id, len(messages) < limit
+                )
 
+            response.headers["ETag"] = etag
             return MessagesResponse(
                 messages=messages_list,
                 total_count=len(messages_list),
@@ -478,14 +596,113 @@ async def get_messages(
             )
 
         except FloodWaitError as e:
-            raise HTTPException(
-                status_code=429,
-                detail={
-                    "error": "Too many requests",
-                    "wait_seconds": e.seconds,
-                    "message": f"Please wait {e.seconds} seconds before making another request"
-                }
-            )
+            raise flood_wait_error(e)
+
+    except HTTPException:
+        raise
+    except FloodWaitError as e:
+        raise flood_wait_error(e)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 
+def encode_export_cursor(chat_id: str, offset_id: int, reverse: bool) -> str:
+    payload = json.dumps({"c": normalize_chat_key(chat_id), "o": offset_id, "r": reverse})
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_export_cursor(cursor: str, chat_id: str) -> tuple[int, bool]:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        offset_id, reverse = int(payload["o"]), bool(payload["r"])
+        cursor_chat = payload["c"]
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if cursor_chat != normalize_chat_key(chat_id):
+        raise HTTPException(status_code=400, detail="Cursor belongs to another chat")
+    return offset_id, reverse
+
+
+@app.get("/messages/export")
+async def export_messages(
+        chat_id: str,
+        cursor: Optional[str] = None,
+        reverse: bool = False,
+        format: Literal["ndjson", "length-prefixed"] = "ndjson",
+        session_string: str = Header(..., alias="X-Session-String")
+):
+    """Stream the whole chat history.
+
+    Every record is ``{"message": MessageInfo, "cursor": str}``; passing the
+    cursor of the last received record continues an interrupted export.
+    The stream ends with ``{"done": true, "count": int}``. With
+    ``format=length-prefixed`` each record is preceded by its size as a
+    4-byte big-endian integer instead of being newline-terminated.
+    ``reverse=true`` exports from the oldest message.
+    """
+    try:
+        client = await get_client_from_session(session_string)
+
+        offset_id = 0
+        if cursor:
+            offset_id, reverse = decode_export_cursor(cursor, chat_id)
+
+        try:
+            entity = await resolve_peer(client, chat_id)
+        except ValueError as e:
+            raise HTTPException(status_code=404, detail=f"Chat not found: {str(e)}")
+
+        def frame(record: bytes) -> bytes:
+            if format == "length-prefixed":
+                return len(record).to_bytes(4, "big") + record
+            return record + b"\n"
+
+        async def records():
+            count = 0
+            with bulk_priority():
+                # Паузы между запросами не нужны - их обеспечивает rate limiter
+                async for msg in client.iter_messages(entity, offset_id=offset_id, reverse=reverse, wait_time=0):
+                    count += 1
+                    record_cursor = encode_export_cursor(chat_id, msg.id, reverse)
+                    if FAST_JSON:
+                        yield frame(dumps({"message": message_payload(msg), "cursor": record_cursor}))
+                    else:
+                        yield frame(
+                            ExportRecord(message=build_message_info(msg), cursor=record_cursor)
+                            .model_dump_json().encode()
+                        )
+            yield frame(dumps({"done": True, "count": count}))
+
+        media_type = "application/x-ndjson" if format == "ndjson" else "application/octet-stream"
+        # Long exports must not lose their client to the idle reaper
+        return StreamingResponse(pinned_stream(session_string, records()), media_type=media_type)
+    except HTTPException:
+        raise
+    except FloodWaitError as e:
+        raise flood_wait_error(e)
     except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/messages/since", response_model=ChangesResponse)
+async def get_messages_since(
+        token: Optional[str] = None,
+        chat_id: Optional[str] = None,
+        session_string: str = Header(..., alias="X-Session-String")
+):
+    """New, edited and deleted messages since the checkpoint token.
+
+    Call without token to get the current checkpoint. Pass the returned
+    token to the next call; repeat while has_more is true. Without chat_id
+    changes of all private chats and groups are returned, channels with
+    changes are listed in changed_channels and need their own chat_id.
+    """
+    try:
+        client = await get_client_from_session(session_string)
+        return await get_changes(client, token, chat_id)
+    except HTTPException:
+        raise
+    except FloodWaitError as e:
+        raise flood_wait_error(e)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
@@ -0,0 +1,407 @@
+import asyncio
+import math
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Optional, TypeVar
+
+from fastapi import HTTPException
+from telethon import TelegramClient
+from telethon.sessions import StringSession
+
+from telegram_api_server_stateless_cluster import add_route_hint
+from telegram_api_server_stateless_utils import (
+    CLIENT_POOL_CLOSE_TIMEOUT,
+    PooledTelegramClient,
+    decode_session_with_credentials,
+    encode_session_with_credentials,
+    safe_disconnect,
+    session_fingerprint
+)
+
+# Path to SQLite file with sign-ins waiting for a code, so they survive a restart of the worker
+PENDING_AUTH_DB = os.getenv("PENDING_AUTH_DB")
+# Seconds a sign-in may take from /auth/send_code to the last verify call
+PENDING_AUTH_TTL = float(os.getenv("PENDING_AUTH_TTL", "600"))
+# Most sign-ins pending at once on one worker; more get 429
+PENDING_AUTH_MAX_SIZE = int(os.getenv("PENDING_AUTH_MAX_SIZE", "200"))
+PENDING_AUTH_REAP_INTERVAL = float(os.getenv("PENDING_AUTH_REAP_INTERVAL", "30"))
+
+T = TypeVar("T")
+
+
+@dataclass
+class PendingAuth:
+    phone: str
+    phone_code_hash: str
+    created: float
+
+
+class PendingAuthStore:
+    """Sign-ins between /auth/send_code and a completed login, keyed by session fingerprint.
+
+    The session string sent back by the client carries the auth key, so
+    with the phone and code hash kept here a sign-in can be finished by a
+    new client, e.g. after the worker restarted. Without ``db_path``
+    entries live in memory.
+    Entries older than ``ttl`` are ignored and removed by ``purge_expired``.
+    SQLite runs on a thread of its own; removals are queued without being
+    waited for, later reads still see them.
+    """
+
+    def __init__(self, db_path: Optional[str] = None, ttl: float = PENDING_AUTH_TTL):
+        self.ttl = ttl
+        self._entries: dict[str, PendingAuth] = {}
+        self._db: Optional[sqlite3.Connection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # Stored sign-ins, counted after every write
+        self._size = 0
+        self.write_errors = 0
+        if db_path:
+            # Phone numbers and code hashes of sign-ins, only the owner may read them
+            os.close(os.open(db_path, os.O_CREAT | os.O_RDWR, 0o600))
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS pending_auth ("
+                "key TEXT PRIMARY KEY, phone TEXT NOT NULL, phone_code_hash TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self._db.commit()
+            self._size = self._count()
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pending-auth")
+
+    async def _run(self, func: Callable[..., T], *args) -> T:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _submit(self, func: Callable[..., int], *args):
+        future = self._executor.submit(func, *args)
+        future.add_done_callback(self._write_done)
+
+    def _write_done(self, future: Future):
+        # A row left behind is ignored once expired and removed by the next purge
+        if future.exception() is not None:
+            self.write_errors += 1
+        else:
+            self._size = future.result()
+
+    def _count(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM pending_auth").fetchone()[0]
+
+    async def put(self, session_string: str, phone: str, phone_code_hash: str):
+        key = session_fingerprint(session_string)
+        pending = PendingAuth(phone, phone_code_hash, time.time())
+        if self._db is None:
+            self._entries[key] = pending
+            return
+        # Waited for, so another worker finds the sign-in as soon as the client has its session
+        self._size = await self._run(self._insert, key, pending)
+
+    def _insert(self, key: str, pending: PendingAuth) -> int:
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO pending_auth VALUES (?, ?, ?, ?)",
+                (key, pending.phone, pending.phone_code_hash, pending.created),
+            )
+        return self._count()
+
+    async def get(self, session_string: str) -> Optional[PendingAuth]:
+        key = session_fingerprint(session_string)
+        if self._db is None:
+            pending = self._entries.get(key)
+        else:
+            row = await self._run(self._select, key)
+            pending = PendingAuth(*row) if row else None
+        if pending is None or pending.created < time.time() - self.ttl:
+            return None
+        return pending
+
+    def _select(self, key: str) -> Optional[tuple]:
+        return self._db.execute(
+            "SELECT phone, phone_code_hash, created FROM pending_auth WHERE key = ?", (key,)
+        ).fetchone()
+
+    def discard(self, session_string: str):
+        key = session_fingerprint(session_string)
+        if self._db is None:
+            self._entries.pop(key, None)
+            return
+        self._submit(self._delete, key)
+
+    def _delete(self, key: str) -> int:
+        with self._db:
+            self._db.execute("DELETE FROM pending_auth WHERE key = ?", (key,))
+        return self._count()
+
+    def purge_expired(self):
+        deadline = time.time() - self.ttl
+        if self._db is None:
+            expired = [key for key, pending in self._entries.items() if pending.created < deadline]
+            for key in expired:
+                del self._entries[key]
+            return
+        self._submit(self._purge, deadline)
+
+    def _purge(self, deadline: float) -> int:
+        with self._db:
+            self._db.execute("DELETE FROM pending_auth WHERE created < ?", (deadline,))
+        return self._count()
+
+    def stats(self) -> dict:
+        if self._db is None:
+            size = len(self._entries)
+        else:
+            size = self._size
+        return {"size": size, "shared": self._db is not None, "write_errors": self.write_errors}
+
+    def close(self):
+        if self._executor is not None:
+            # Queued removals are finished before the connection goes away
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+@dataclass
+class _PendingClient:
+    client: TelegramClient
+    # Fingerprint of phone and credentials, see PendingClients.send_code
+    login_key: str
+    expires: float
+
+
+class PendingClients:
+    """Connected clients of unfinished sign-ins, kept apart from the client pool.
+
+    Sign-ins never push authenticated clients out of the pool and can not
+    grow without bound: each one is disconnected ``ttl`` seconds after the
+    code was sent, and at most ``max_size`` are pending at once. Requesting
+    a code again for the same phone and credentials reuses the pending
+    client and asks Telegram to resend the code.
+    """
+
+    def __init__(self, store: PendingAuthStore, max_size: int, ttl: float, reap_interval: float):
+        self.store = store
+        self.max_size = max_size
+        self.ttl = ttl
+        self.reap_interval = reap_interval
+        # Kept in order of expiry
+        self._entries: OrderedDict[str, _PendingClient] = OrderedDict()
+        self._by_login: dict[str, str] = {}
+        self._sending: dict[str, asyncio.Task] = {}
+        self._connecting = 0
+        self._closing: set[asyncio.Task] = set()
+        self._reaper: Optional[asyncio.Task] = None
+        self.started = 0
+        self.resent = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.expired = 0
+        self.completed = 0
+
+    def __contains__(self, session_string: str) -> bool:
+        return self.get(session_string) is not None
+
+    def get(self, session_string: str) -> Optional[TelegramClient]:
+        entry = self._entries.get(session_string)
+        if entry is None or entry.expires <= time.monotonic():
+            return None
+        return entry.client
+
+    async def send_code(self, phone: str, api_id: int, api_hash: str) -> str:
+        """Send a login code and return the session string to verify it with"""
+        login_key = session_fingerprint(f"{phone}:{api_id}:{api_hash}")
+        task = self._sending.get(login_key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = asyncio.get_running_loop().create_task(self._send_code(login_key, phone, api_id, api_hash))
+            self._sending[login_key] = task
+            task.add_done_callback(lambda t: self._send_done(login_key, t))
+        # Shield so a cancelled request does not abort the send other requests wait for
+        return await asyncio.shield(task)
+
+    def _send_done(self, login_key: str, task: asyncio.Task):
+        if self._sending.get(login_key) is task:
+            del self._sending[login_key]
+        if not task.cancelled():
+            task.exception()
+
+    async def _send_code(self, login_key: str, phone: str, api_id: int, api_hash: str) -> str:
+        session_string = self._by_login.get(login_key)
+        client = self.get(session_string) if session_string else None
+        if client is not None:
+            sent_code = await client.send_code_request(phone)
+            self.resent += 1
+            # The new code is valid for a full ttl again, as is its entry in the store
+            entry = self._entries.get(session_string)
+            if entry is not None:
+                entry.expires = time.monotonic() + self.ttl
+                self._entries.move_to_end(session_string)
+            await self.store.put(session_string, phone, sent_code.phone_code_hash)
+            return session_string
+
+        self._reserve()
+        client = PooledTelegramClient(session_fingerprint(phone), StringSession(), api_id, api_hash)
+        try:
+            await client.connect()
+            sent_code = await client.send_code_request(phone)
+        except BaseException:
+            await safe_disconnect(client)
+            raise
+        finally:
+            self._connecting -= 1
+
+        # The code hash in the store lets any worker finish the sign-in
+        session_string = add_route_hint(encode_session_with_credentials(client.session.save(), api_id, api_hash))
+        client.session_key = session_fingerprint(session_string)
+        self._add(session_string, client, login_key, time.monotonic() + self.ttl)
+        await self.store.put(session_string, phone, sent_code.phone_code_hash)
+        self.started += 1
+        return session_string
+
+    async def get_or_connect(self, session_string: str) -> Optional[TelegramClient]:
+        """Client of an unfinished sign-in, reconnected if it was started on another worker"""
+        client = self.get(session_string)
+        if client is not None:
+            return client
+        pending = await self.store.get(session_string)
+        if pending is None:
+            return None
+
+        self._reserve()
+        session, api_id, api_hash = decode_session_with_credentials(session_string)
+        client = PooledTelegramClient(session_fingerprint(session_string), StringSession(session), api_id, api_hash)
+        try:
+            await client.connect()
+        except BaseException:
+            await safe_disconnect(client)
+            raise
+        finally:
+            self._connecting -= 1
+
+        # Another request may have connected it meanwhile
+        existing = self.get(session_string)
+        if existing is not None:
+            await safe_disconnect(client)
+            return existing
+        login_key = session_fingerprint(f"{pending.phone}:{api_id}:{api_hash}")
+        expires = time.monotonic() + pending.created + self.ttl - time.time()
+        self._add(session_string, client, login_key, expires)
+        return client
+
+    def complete(self, session_string: str):
+        """Sign-in finished: forget it, the client now belongs to the caller"""
+        entry = self._entries.pop(session_string, None)
+        if entry is not None:
+            self._forget_login(entry.login_key, session_string)
+            self.completed += 1
+        self.store.discard(session_string)
+
+    def _reserve(self):
+        if len(self._entries) + self._connecting >= self.max_size:
+            self.reap_expired()
+        if len(self._entries) + self._connecting >= self.max_size:
+            self.rejected += 1
+            wait_seconds = self._retry_after()
+            raise HTTPException(
+                status_code=429,
+                detail={
+                    "error": "Too many pending sign-ins",
+                    "wait_seconds": wait_seconds,
+                    "message": f"Please wait {wait_seconds} seconds before requesting another code"
+                },
+                headers={"Retry-After": str(wait_seconds)}
+            )
+        self._connecting += 1
+
+    def _retry_after(self) -> int:
+        if not self._entries:
+            return 1
+        oldest = next(iter(self._entries.values()))
+        return max(1, math.ceil(oldest.expires - time.monotonic()))
+
+    def _add(self, session_string: str, client: TelegramClient, login_key: str, expires: float):
+        previous = self._by_login.get(login_key)
+        if previous is not None and previous != session_string:
+            # A new code for the same login replaces the expired attempt
+            self._drop(previous)
+        last = next(reversed(self._entries.values()), None)
+        self._entries[session_string] = _PendingClient(client, login_key, expires)
+        self._by_login[login_key] = session_string
+        if last is not None and last.expires > expires:
+            # Adopted from another worker, it expires before entries started here
+            self._entries = OrderedDict(sorted(self._entries.items(), key=lambda item: item[1].expires))
+
+    def _forget_login(self, login_key: str, session_string: str):
+        if self._by_login.get(login_key) == session_string:
+            del self._by_login[login_key]
+
+    def _drop(self, session_string: str):
+        entry = self._entries.pop(session_string, None)
+        if entry is None:
+            return
+        self._forget_login(entry.login_key, session_string)
+        task = asyncio.get_running_loop().create_task(safe_disconnect(entry.client))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    def reap_expired(self) -> int:
+        """Disconnect clients of sign-ins that were not finished within ttl"""
+        now = time.monotonic()
+        expired = []
+        for session_string, entry in self._entries.items():
+            if entry.expires > now:
+                break
+            expired.append(session_string)
+        for session_string in expired:
+            self._drop(session_string)
+            self.store.discard(session_string)
+        self.expired += len(expired)
+        return len(expired)
+
+    async def _reap_forever(self):
+        while True:
+            await asyncio.sleep(self.reap_interval)
+            self.reap_expired()
+            self.store.purge_expired()
+
+    def start_reaper(self):
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.get_running_loop().create_task(self._reap_forever())
+
+    async def close(self):
+        """Stop the reaper and disconnect the clients of all pending sign-ins"""
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        entries = list(self._entries.values())
+        self._entries.clear()
+        self._by_login.clear()
+        tasks = [asyncio.ensure_future(safe_disconnect(entry.client)) for entry in entries]
+        tasks.extend(self._closing)
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=CLIENT_POOL_CLOSE_TIMEOUT)
+            for task in pending:
+                task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "connecting": self._connecting,
+            "started": self.started,
+            "resent": self.resent,
+            "coalesced": self.coalesced,
+            "rejected": self.rejected,
+            "expired": self.expired,
+            "completed": self.completed,
+        }
+
+
+pending_auth = PendingAuthStore(PENDING_AUTH_DB)
+pending_clients = PendingClients(pending_auth, PENDING_AUTH_MAX_SIZE, PENDING_AUTH_TTL, PENDING_AUTH_REAP_INTERVAL)
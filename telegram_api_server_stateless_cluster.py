@@ -0,0 +1,395 @@
+"""Session-affinity routing for running the server as several worker processes.
+
+Every session is owned by one worker, chosen by consistent hashing of its
+fingerprint, so each MTProto connection lives in exactly one process.
+Workers forward requests for sessions they do not own to the owner,
+signing them with CLUSTER_SECRET; sign-ins are finished on the worker
+that sent the code. The front process started by ``main()`` only forwards:
+
+    python telegram_api_server_stateless_cluster.py --workers 4 --port 8000
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import itertools
+import os
+import secrets
+import signal
+import subprocess
+import sys
+import time
+from bisect import bisect
+from typing import List, Optional
+
+import httpx
+from starlette.datastructures import Headers
+
+from telegram_api_server_stateless_utils import session_fingerprint, session_from_subprotocols
+
+# Base URLs of all workers (comma separated); routing is disabled when not set
+CLUSTER_NODES = [node.strip().rstrip("/") for node in os.getenv("CLUSTER_NODES", "").split(",") if node.strip()]
+# Base URL of this worker as listed in CLUSTER_NODES
+CLUSTER_SELF = os.getenv("CLUSTER_SELF", "").rstrip("/") or None
+# Seconds to wait for a connection to another worker
+CLUSTER_CONNECT_TIMEOUT = float(os.getenv("CLUSTER_CONNECT_TIMEOUT", "5"))
+# Shared by all workers; signs forwarded requests so clients can not pose as another worker
+CLUSTER_SECRET = os.getenv("CLUSTER_SECRET", "")
+# Seconds a forwarded request's signature stays valid; workers' clocks must agree this closely
+CLUSTER_SIGNATURE_MAX_AGE = float(os.getenv("CLUSTER_SIGNATURE_MAX_AGE", "30"))
+
+# Set on forwarded requests, so they are never forwarded again; "<unix time>.<signature>"
+FORWARDED_HEADER = "x-cluster-forwarded"
+
+# Points per node on the ring; more points spread sessions more evenly
+_VIRTUAL_NODES = 160
+# Headers that only apply to a single connection
+_HOP_HEADERS = {
+    b"connection", b"keep-alive", b"proxy-connection", b"transfer-encoding", b"upgrade", b"te", b"trailer", b"host"
+}
+
+
+def _ring_hash(value: str) -> int:
+    return int.from_bytes(hashlib.sha256(value.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hash ring: adding or removing a node moves only its share of sessions"""
+
+    def __init__(self, nodes: List[str], virtual_nodes: int = _VIRTUAL_NODES):
+        if not nodes:
+            raise ValueError("Hash ring needs at least one node")
+        self.nodes = list(nodes)
+        points = sorted((_ring_hash(f"{node}#{i}"), node) for node in nodes for i in range(virtual_nodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def owner(self, key: str) -> str:
+        index = bisect(self._hashes, _ring_hash(key)) % len(self._hashes)
+        return self._owners[index]
+
+
+def node_tag(node: str) -> str:
+    """Short name of a worker, appended to session strings of sign-ins it started"""
+    return hashlib.sha256(node.encode()).hexdigest()[:8]
+
+
+def route_hint(session_string: str) -> Optional[str]:
+    """Node tag of a pending sign-in session, see add_route_hint"""
+    parts = session_string.split(":")
+    return parts[2] if len(parts) > 2 else None
+
+
+def add_route_hint(session_string: str) -> str:
+    """Mark a sign-in session with this worker, so the verify calls come back to it.
+
+    The client of the sign-in only lives on the worker that sent the code;
+    the session string returned after sign-in has no hint.
+    """
+    return f"{session_string}:{node_tag(CLUSTER_SELF)}" if CLUSTER_SELF else session_string
+
+
+def _session_of(scope) -> Optional[str]:
+    session = Headers(scope=scope).get("x-session-string")
+    if session is None and scope["type"] == "websocket":
+        # Browsers can not set WebSocket headers, /updates also takes it from a subprotocol
+        offered = session_from_subprotocols(scope.get("subprotocols", ()))
+        session = offered[1] if offered else None
+    return session
+
+
+def _without_forwarded_header(scope) -> dict:
+    headers = [(key, value) for key, value in scope["headers"] if key.lower() != FORWARDED_HEADER.encode()]
+    return dict(scope, headers=headers)
+
+
+class ClusterRouter:
+    """Decides which worker serves a request and forwards it there.
+
+    With ``self_node=None`` (the front process) nothing is served locally:
+    requests without a session are spread over the workers round-robin.
+    """
+
+    def __init__(self, nodes: List[str], self_node: Optional[str], secret: str,
+                 max_age: float = CLUSTER_SIGNATURE_MAX_AGE):
+        if not secret:
+            raise ValueError("CLUSTER_SECRET is required to route requests between workers")
+        self.ring = HashRing(nodes)
+        self.self_node = self_node
+        self._secret = secret.encode()
+        self.max_age = max_age
+        self._tags = {node_tag(node): node for node in self.ring.nodes}
+        self._round_robin = itertools.cycle(self.ring.nodes)
+        self._http: Optional[httpx.AsyncClient] = None
+        self.forwarded = 0
+        self.forward_errors = 0
+
+    def _signature(self, scope, timestamp: int) -> str:
+        # The body is not signed: it is streamed through and may be large
+        message = "\n".join((
+            str(timestamp),
+            f"{scope.get('method', 'WEBSOCKET')} {scope['path']}?{scope.get('query_string', b'').decode()}",
+            _session_of(scope) or "",
+        ))
+        return hmac.new(self._secret, message.encode(), hashlib.sha256).hexdigest()
+
+    def _forwarded_value(self, scope) -> str:
+        timestamp = int(time.time())
+        return f"{timestamp}.{self._signature(scope, timestamp)}"
+
+    def is_forwarded(self, scope) -> bool:
+        """Whether the request was forwarded by another worker just now, checked by its signature"""
+        value = Headers(scope=scope).get(FORWARDED_HEADER)
+        if value is None:
+            return False
+        timestamp, _, signature = value.partition(".")
+        try:
+            timestamp = int(timestamp)
+        except ValueError:
+            return False
+        if abs(time.time() - timestamp) > self.max_age:
+            return False
+        return hmac.compare_digest(signature, self._signature(scope, timestamp))
+
+    def serves(self, session_string: str) -> bool:
+        """Whether this worker owns the session, e.g. to keep its client after a sign-in"""
+        return self.owner(session_string) == self.self_node
+
+    def owner(self, session_string: str) -> str:
+        node = self._tags.get(route_hint(session_string) or "")
+        return node if node is not None else self.ring.owner(session_fingerprint(session_string))
+
+    def target(self, scope) -> Optional[str]:
+        """Worker to forward the request to, None to serve it here"""
+        if self.self_node is not None and self.is_forwarded(scope):
+            return None
+        session = _session_of(scope)
+        if session is None:
+            return None if self.self_node is not None else next(self._round_robin)
+        owner = self.owner(session)
+        return None if owner == self.self_node else owner
+
+    def owns(self, key: str) -> bool:
+        """Whether this worker serves the session with fingerprint ``key``"""
+        return self.self_node is None or self.ring.owner(key) == self.self_node
+
+    async def forward(self, node: str, scope, receive, send):
+        self.forwarded += 1
+        if scope["type"] == "http":
+            await self._forward_http(node, scope, receive, send)
+        else:
+            await self._forward_websocket(node, scope, receive, send)
+
+    @staticmethod
+    def _url(node: str, scope) -> str:
+        url = node + scope.get("root_path", "") + scope["path"]
+        if scope["type"] == "websocket":
+            # http://... -> ws://..., https://... -> wss://...
+            url = "ws" + url[4:]
+        if scope.get("query_string"):
+            url += "?" + scope["query_string"].decode()
+        return url
+
+    def _forward_headers(self, scope) -> list[tuple[bytes, bytes]]:
+        headers = [
+            (key, value) for key, value in scope["headers"]
+            if key.lower() not in _HOP_HEADERS and key.lower() != FORWARDED_HEADER.encode()
+        ]
+        headers.append((FORWARDED_HEADER.encode(), self._forwarded_value(scope).encode()))
+        return headers
+
+    def _client(self) -> httpx.AsyncClient:
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                # Streams (export, SSE) may stay open for a long time, only connecting is bounded
+                timeout=httpx.Timeout(None, connect=CLUSTER_CONNECT_TIMEOUT),
+                limits=httpx.Limits(max_connections=None, max_keepalive_connections=100),
+            )
+        return self._http
+
+    async def _forward_http(self, node: str, scope, receive, send):
+        disconnected = False
+
+        async def body():
+            nonlocal disconnected
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    disconnected = True
+                    return
+                yield message.get("body", b"")
+                if not message.get("more_body"):
+                    return
+
+        request = self._client().build_request(
+            scope["method"], self._url(node, scope), headers=self._forward_headers(scope), content=body()
+        )
+        try:
+            response = await self._client().send(request, stream=True)
+        except httpx.HTTPError:
+            self.forward_errors += 1
+            await send({"type": "http.response.start", "status": 502,
+                        "headers": [(b"content-type", b"application/json")]})
+            await send({"type": "http.response.body", "body": b'{"detail":"Session owner is not reachable"}'})
+            return
+
+        async def relay():
+            await send({
+                "type": "http.response.start",
+                "status": response.status_code,
+                "headers": [(key, value) for key, value in response.headers.raw if key.lower() not in _HOP_HEADERS],
+            })
+            async for chunk in response.aiter_raw():
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+
+        async def wait_disconnect():
+            if disconnected:
+                return
+            while (await receive())["type"] != "http.disconnect":
+                pass
+
+        # Streams (SSE, export) never end by themselves: closing the upstream response
+        # when the client goes away stops them on the owner as well
+        relaying = asyncio.ensure_future(relay())
+        watching = asyncio.ensure_future(wait_disconnect())
+        try:
+            await asyncio.wait((relaying, watching), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in (relaying, watching):
+                task.cancel()
+            await asyncio.gather(relaying, watching, return_exceptions=True)
+            await response.aclose()
+        if not relaying.cancelled() and relaying.exception() is not None:
+            raise relaying.exception()
+
+    async def _forward_websocket(self, node: str, scope, receive, send):
+        from websockets.asyncio.client import connect
+
+        await receive()  # websocket.connect
+        headers = [(key.decode("latin-1"), value.decode("latin-1")) for key, value in self._forward_headers(scope)
+                   if not key.lower().startswith(b"sec-websocket")]
+        try:
+            upstream = await connect(
+                self._url(node, scope), additional_headers=headers, open_timeout=CLUSTER_CONNECT_TIMEOUT,
+                subprotocols=scope.get("subprotocols") or None
+            )
+        except Exception:
+            self.forward_errors += 1
+            await send({"type": "websocket.close", "code": 1011})
+            return
+
+        await send({"type": "websocket.accept", "subprotocol": upstream.subprotocol})
+
+        async def to_upstream():
+            while True:
+                message = await receive()
+                if message["type"] == "websocket.disconnect":
+                    return
+                data = message.get("text")
+                await upstream.send(data if data is not None else message.get("bytes"))
+
+        async def from_upstream():
+            async for data in upstream:
+                key = "text" if isinstance(data, str) else "bytes"
+                await send({"type": "websocket.send", key: data})
+            await send({"type": "websocket.close", "code": upstream.close_code or 1000})
+
+        async with upstream:
+            tasks = [asyncio.ensure_future(to_upstream()), asyncio.ensure_future(from_upstream())]
+            try:
+                await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "nodes": len(self.ring.nodes),
+            "self": self.self_node,
+            "forwarded": self.forwarded,
+            "forward_errors": self.forward_errors,
+        }
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+
+class SessionAffinityMiddleware:
+    """ASGI middleware that serves a request only on the worker owning its session"""
+
+    def __init__(self, app, router: ClusterRouter):
+        self.app = app
+        self.router = router
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+        node = self.router.target(scope)
+        if node is not None:
+            await self.router.forward(node, scope, receive, send)
+        elif self.router.is_forwarded(scope):
+            await self.app(scope, receive, send)
+        else:
+            # An unsigned header sent by a client means nothing
+            await self.app(_without_forwarded_header(scope), receive, send)
+
+
+class _FrontApp:
+    """Front process: forwards every request, serves nothing itself"""
+
+    def __init__(self, router: ClusterRouter):
+        self.router = router
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] in ("http", "websocket"):
+            # The front never serves requests, so a forwarded header from a client is ignored
+            await self.router.forward(self.router.target(scope), scope, receive, send)
+
+
+cluster_router = (
+    ClusterRouter(CLUSTER_NODES, CLUSTER_SELF, CLUSTER_SECRET) if CLUSTER_NODES and CLUSTER_SELF else None
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the server as several workers behind a routing front")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--worker-port", type=int, default=None,
+                        help="Port of the first worker, the next ones follow (default: port + 1)")
+    args = parser.parse_args()
+
+    import uvicorn
+
+    first_port = args.worker_port or args.port + 1
+    nodes = [f"http://127.0.0.1:{first_port + i}" for i in range(args.workers)]
+    secret = os.environ.get("CLUSTER_SECRET") or secrets.token_hex(32)
+    env = dict(os.environ, CLUSTER_NODES=",".join(nodes), CLUSTER_SECRET=secret)
+
+    workers = [
+        subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "telegram_api_server_stateless:app",
+             "--host", "127.0.0.1", "--port", str(first_port + i)],
+            env=dict(env, CLUSTER_SELF=node),
+        )
+        for i, node in enumerate(nodes)
+    ]
+    # uvicorn re-raises the signal it stopped on; exit normally so the workers are stopped too
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        uvicorn.run(_FrontApp(ClusterRouter(nodes, None, secret)), host=args.host, port=args.port, lifespan="off")
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.wait()
+
+
+if __name__ == "__main__":
+    main()
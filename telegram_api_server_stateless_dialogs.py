@@ -0,0 +1,347 @@
+import asyncio
+import base64
+import json
+import os
+import re
+import time
+import unicodedata
+import uuid
+import weakref
+from bisect import bisect_left, bisect_right, insort
+from dataclasses import dataclass
+from typing import Iterable, List, Optional
+
+from fastapi import HTTPException
+from telethon import TelegramClient, events
+from telethon.tl import types
+from telethon.tl.functions.updates import GetStateRequest
+from telethon.utils import get_display_name, get_peer_id
+
+from telegram_api_server_stateless_models import ChatInfo, build_chat_info
+from telegram_api_server_stateless_peers import peer_cache
+from telegram_api_server_stateless_scheduler import bulk_priority
+
+# Seconds after which a dialog snapshot is fetched again even if kept current by events
+DIALOG_CACHE_TTL = float(os.getenv("DIALOG_CACHE_TTL", "3600"))
+
+CHAT_TYPES = ("channel", "supergroup", "group", "private")
+
+
+@dataclass
+class DialogEntry:
+    info: ChatInfo
+    date: float
+    pinned: bool
+
+    @property
+    def sort_key(self) -> tuple:
+        # Same order as in Telegram apps: pinned first, then by last message
+        return (not self.pinned, -self.date, self.info.id)
+
+
+def encode_chats_cursor(entry: DialogEntry) -> str:
+    data = json.dumps({"p": entry.pinned, "d": entry.date, "i": entry.info.id})
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip("=")
+
+
+def decode_chats_cursor(cursor: str) -> tuple:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return (not data["p"], -float(data["d"]), int(data["i"]))
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def normalize_search_text(text: str) -> str:
+    """Lowercase text without diacritics, so that "Café" is found by cafe"""
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(ch for ch in decomposed if not unicodedata.combining(ch)).casefold()
+
+
+class DialogIndex:
+    """Word prefix index over chat names and usernames.
+
+    Keeps a sorted list of (word, chat id), so a prefix lookup is two
+    bisections and updates are single inserts or removals.
+    """
+
+    def __init__(self, infos: Iterable[ChatInfo] = ()):
+        self._words: List[tuple[str, int]] = []
+        self._names: dict[int, str] = {}
+        self._usernames: dict[int, Optional[str]] = {}
+        self._chat_tokens: dict[int, set[str]] = {}
+        for info in infos:
+            self._store(info)
+            self._words.extend((token, info.id) for token in self._chat_tokens[info.id])
+        self._words.sort()
+
+    def _store(self, info: ChatInfo):
+        self._names[info.id] = normalize_search_text(info.name)
+        self._usernames[info.id] = info.username.lower() if info.username else None
+        self._chat_tokens[info.id] = self._tokens(info)
+
+    @staticmethod
+    def _tokens(info: ChatInfo) -> set[str]:
+        tokens = set(_WORD_RE.findall(normalize_search_text(info.name)))
+        if info.username:
+            tokens.add(info.username.lower())
+        return tokens
+
+    def add(self, info: ChatInfo):
+        self.remove(info.id)
+        self._store(info)
+        for token in self._chat_tokens[info.id]:
+            insort(self._words, (token, info.id))
+
+    def remove(self, chat_id: int):
+        if chat_id not in self._names:
+            return
+        del self._names[chat_id]
+        del self._usernames[chat_id]
+        for token in self._chat_tokens.pop(chat_id):
+            position = bisect_left(self._words, (token, chat_id))
+            del self._words[position]
+
+    def _prefix(self, prefix: str) -> set[int]:
+        start = bisect_left(self._words, (prefix,))
+        end = bisect_left(self._words, (prefix + "\U0010ffff",))
+        return {chat_id for _, chat_id in self._words[start:end]}
+
+    def search(self, query: str) -> List[tuple[int, int]]:
+        """Return (rank, chat id) of chats whose words start with every query word"""
+        query = normalize_search_text(query.strip().lstrip("@"))
+        terms = _WORD_RE.findall(query)
+        if not terms:
+            return []
+        matches = None
+        for term in sorted(terms, key=len, reverse=True):
+            found = self._prefix(term)
+            matches = found if matches is None else matches & found
+            if not matches:
+                return []
+
+        results = []
+        for chat_id in matches:
+            name = self._names[chat_id]
+            username = self._usernames[chat_id]
+            if name == query or username == query:
+                rank = 0
+            elif name.startswith(query) or (username and username.startswith(query)):
+                rank = 1
+            else:
+                rank = 2
+            results.append((rank, chat_id))
+        return results
+
+
+class DialogSnapshot:
+    """All dialogs of one account, kept current from update events.
+
+    The snapshot does not reference its client, so it is dropped together
+    with the client when the pool evicts it.
+    """
+
+    def __init__(self, entries: List[DialogEntry]):
+        self._entries = {entry.info.id: entry for entry in entries}
+        self._sorted: Optional[List[DialogEntry]] = None
+        self._sort_keys: Optional[List[tuple]] = None
+        self._index = DialogIndex(entry.info for entry in entries)
+        self.created = time.monotonic()
+        self.stale = False
+        # Identifies the snapshot and its state in ETags of /chats
+        self.snapshot_id = uuid.uuid4().hex
+        self.version = 0
+        self.events = 0
+        self._handlers = [
+            (self._on_new_message, events.NewMessage()),
+            (self._on_chat_action, events.ChatAction()),
+            (self._on_channel, events.Raw(types.UpdateChannel)),
+        ]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def expired(self) -> bool:
+        return self.stale or time.monotonic() - self.created > DIALOG_CACHE_TTL
+
+    def attach(self, client: TelegramClient):
+        for callback, event in self._handlers:
+            client.add_event_handler(callback, event)
+
+    def detach(self, client: TelegramClient):
+        for callback, _ in self._handlers:
+            client.remove_event_handler(callback)
+
+    def _changed(self):
+        self._sorted = None
+        self._sort_keys = None
+        self.version += 1
+
+    def _put(self, entry: DialogEntry):
+        self._entries[entry.info.id] = entry
+        self._index.add(entry.info)
+        self._changed()
+
+    def _remove(self, chat_id: int):
+        if self._entries.pop(chat_id, None) is not None:
+            self._index.remove(chat_id)
+            self._changed()
+
+    async def _upsert(self, event, date: float):
+        entry = self._entries.get(event.chat_id)
+        if entry is not None:
+            if date > entry.date:
+                entry.date = date
+                self._changed()
+            return
+        chat = await event.get_chat()
+        info = build_chat_info(chat, get_display_name(chat)) if chat is not None else None
+        if info is not None:
+            self._put(DialogEntry(info, date, False))
+
+    async def _self_id(self, client: TelegramClient) -> int:
+        return (await client.get_me(input_peer=True)).user_id
+
+    async def _on_new_message(self, event):
+        self.events += 1
+        await self._upsert(event, event.message.date.timestamp())
+
+    async def _on_chat_action(self, event):
+        self.events += 1
+        if event.new_title:
+            entry = self._entries.get(event.chat_id)
+            if entry is not None:
+                entry.info = entry.info.model_copy(update={"name": event.new_title})
+                self._index.add(entry.info)
+                self._changed()
+        if not event.user_ids and not event.created:
+            return
+        is_self = event.created or await self._self_id(event.client) in event.user_ids
+        if not is_self:
+            return
+        if event.user_left or event.user_kicked:
+            self._remove(event.chat_id)
+        else:
+            date = event.action_message.date.timestamp() if event.action_message else time.time()
+            await self._upsert(event, date)
+
+    async def _on_channel(self, update: types.UpdateChannel):
+        # Sent when the account joins, leaves or is removed from a channel
+        self.events += 1
+        chat_id = get_peer_id(types.PeerChannel(update.channel_id))
+        try:
+            channel = await update._client.get_entity(types.PeerChannel(update.channel_id))
+        except Exception:
+            self.stale = True
+            return
+        if isinstance(channel, types.ChannelForbidden) or getattr(channel, "left", False):
+            self._remove(chat_id)
+        elif chat_id not in self._entries:
+            self._put(DialogEntry(build_chat_info(channel, get_display_name(channel)), time.time(), False))
+
+    def sorted(self) -> List[DialogEntry]:
+        if self._sorted is None:
+            self._sorted = sorted(self._entries.values(), key=lambda entry: entry.sort_key)
+            self._sort_keys = [entry.sort_key for entry in self._sorted]
+        return self._sorted
+
+    def page(self, limit: int, cursor: Optional[str] = None,
+             chat_types: Optional[set[str]] = None) -> tuple[List[ChatInfo], int, Optional[str]]:
+        """Return chats after cursor, total count matching filter and cursor of next page"""
+        entries = self.sorted()
+        keys = self._sort_keys
+        if chat_types:
+            entries = [entry for entry in entries if entry.info.type in chat_types]
+            keys = [entry.sort_key for entry in entries]
+        start = 0
+        if cursor:
+            start = bisect_right(keys, decode_chats_cursor(cursor))
+        selected = entries[start:start + limit]
+        next_cursor = None
+        if selected and start + limit < len(entries):
+            next_cursor = encode_chats_cursor(selected[-1])
+        return [entry.info for entry in selected], len(entries), next_cursor
+
+    def search(self, query: str, limit: int,
+               chat_types: Optional[set[str]] = None) -> tuple[List[ChatInfo], int]:
+        """Return best matching chats and number of all matches.
+
+        Exact name or username matches come first, then names starting with
+        the query, then other word matches; ties keep the dialog order.
+        """
+        ranked = []
+        for rank, chat_id in self._index.search(query):
+            entry = self._entries[chat_id]
+            if not chat_types or entry.info.type in chat_types:
+                ranked.append(((rank, *entry.sort_key), entry.info))
+        ranked.sort(key=lambda item: item[0])
+        return [info for _, info in ranked[:limit]], len(ranked)
+
+
+class DialogCache:
+    """Dialog snapshots of pooled clients.
+
+    A snapshot is fetched with one pass over all dialogs and then updated
+    from new message and membership events, so listing chats does not ask
+    Telegram again. Concurrent requests wait for a single fetch.
+    """
+
+    def __init__(self):
+        self._snapshots: weakref.WeakKeyDictionary[TelegramClient, DialogSnapshot] = weakref.WeakKeyDictionary()
+        self._loading: dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, client: TelegramClient, refresh: bool = False) -> DialogSnapshot:
+        snapshot = self._snapshots.get(client)
+        if snapshot is not None and not refresh and not snapshot.expired:
+            self.hits += 1
+            return snapshot
+
+        self.misses += 1
+        task = self._loading.get(client.session_key)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(self._load(client))
+            self._loading[client.session_key] = task
+            task.add_done_callback(lambda t: self._loading.pop(client.session_key, None))
+        return await asyncio.shield(task)
+
+    async def _load(self, client: TelegramClient) -> DialogSnapshot:
+        # Walks the whole chat list, one request per 100 chats
+        with bulk_priority():
+            dialogs = await client.get_dialogs(limit=None)
+        peer_cache.remember_entities(client.session_key, (dialog.entity for dialog in dialogs))
+
+        entries = []
+        for dialog in dialogs:
+            info = build_chat_info(dialog.entity, dialog.name)
+            if info is not None:
+                date = dialog.date.timestamp() if dialog.date else 0.0
+                entries.append(DialogEntry(info, date, dialog.pinned))
+
+        snapshot = DialogSnapshot(entries)
+        old = self._snapshots.get(client)
+        if old is not None:
+            old.detach(client)
+        snapshot.attach(client)
+        self._snapshots[client] = snapshot
+        # Telegram starts pushing updates to a connection after its first request about update state
+        await client(GetStateRequest())
+        return snapshot
+
+    def stats(self) -> dict:
+        snapshots = list(self._snapshots.values())
+        return {
+            "snapshots": len(snapshots),
+            "dialogs": sum(len(snapshot) for snapshot in snapshots),
+            "events": sum(snapshot.events for snapshot in snapshots),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+dialog_cache = DialogCache()
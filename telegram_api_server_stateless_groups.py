@@ -22,12 +22,15 @@ from telethon.tl.functions.messages import ImportChatInviteRequest, GetFullChatR
 from telethon.tl.types import Channel, Chat
 from telethon.errors import (
     ChannelPrivateError,
+    FloodWaitError,
     InviteHashEmptyError,
     InviteHashExpiredError,
     InviteHashInvalidError,
     UserAlreadyParticipantError
 )
 
+from telegram_api_server_stateless_ratelimit import flood_wait_error
+
 class JoinGroupRequest(BaseModel):
     group_identifier: str
 
@@ -160,5 +163,7 @@ async def join_group(
         raise HTTPException(status_code=400, detail="Invalid invitation link")
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
+    except FloodWaitError as e:
+        raise flood_wait_error(e)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
\ No newline at end of file
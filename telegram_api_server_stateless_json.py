@@ -0,0 +1,41 @@
+import os
+from typing import Any
+
+import pydantic_core
+from fastapi.responses import JSONResponse
+from pydantic_core import to_jsonable_python
+
+from telegram_api_server_stateless_models import MESSAGE_FIELDS, build_message_fields, build_message_info
+
+try:
+    import orjson
+except ModuleNotFoundError:  # optional, pydantic-core is used instead
+    orjson = None
+
+# Build listings as plain dicts and encode them with orjson instead of validating pydantic models
+FAST_JSON = os.getenv("FAST_JSON", "false").lower() in ("1", "true", "yes")
+
+
+def dumps(obj: Any) -> bytes:
+    """Encode dicts, lists, datetimes and pydantic models to compact JSON.
+
+    Output is the same with both encoders: UTC datetimes end with "Z" as
+    in pydantic responses.
+    """
+    if FAST_JSON and orjson is not None:
+        return orjson.dumps(obj, default=to_jsonable_python, option=orjson.OPT_UTC_Z)
+    return pydantic_core.to_json(obj)
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON response that is returned as is, without response_model validation"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def message_payload(msg) -> dict:
+    """All MessageInfo fields of a Telethon message as dict"""
+    if FAST_JSON:
+        return build_message_fields(msg, MESSAGE_FIELDS)
+    return build_message_info(msg).model_dump()
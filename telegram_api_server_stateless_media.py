@@ -0,0 +1,310 @@
+import asyncio
+import os
+import uuid
+from collections import OrderedDict
+from typing import AsyncIterator, Callable, Optional
+from urllib.parse import quote
+
+import aiofiles
+from fastapi import HTTPException
+from fastapi.responses import FileResponse
+from telethon import TelegramClient
+from telethon.tl.custom import Message
+
+# Telegram serves files in parts of at most 512 KB; offsets must be aligned to the part size
+DOWNLOAD_PART_SIZE = 512 * 1024
+
+# Local media cache (override through environment variables), disabled when dir is not set
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR")
+MEDIA_CACHE_MAX_BYTES = int(os.getenv("MEDIA_CACHE_MAX_BYTES", str(1024 ** 3)))
+# Larger files are always streamed from Telegram
+MEDIA_CACHE_MAX_FILE_BYTES = int(os.getenv("MEDIA_CACHE_MAX_FILE_BYTES", str(50 * 1024 ** 2)))
+
+
+def media_file_info(message: Message) -> tuple[str, str, Optional[int]]:
+    """Return content type, file name and size (if known) of message media"""
+    content_type = "application/octet-stream"
+    file = message.file
+    filename = None
+    size = None
+    if file is not None:
+        filename = file.name
+        size = file.size
+    if not filename:
+        kind = "photo" if message.photo else "video" if message.video else "document"
+        ext = file.ext if file is not None and file.ext else ""
+        filename = f"{kind}_{message.date:%Y-%m-%d_%H-%M-%S}{ext}"
+
+    if message.photo:
+        content_type = "image/jpeg"
+        if not filename.endswith('.jpg'):
+            filename += '.jpg'
+    elif message.video:
+        content_type = "video/mp4"
+        if not filename.endswith('.mp4'):
+            filename += '.mp4'
+    elif message.document:
+        if message.document.mime_type:
+            content_type = message.document.mime_type
+
+    return content_type, filename, size
+
+
+def content_disposition(filename: str) -> str:
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+
+def parse_range(range_header: Optional[str], size: Optional[int]) -> Optional[tuple[int, int]]:
+    """Parse single "bytes=" range into inclusive (start, end).
+
+    Returns None when the whole file should be sent (also for invalid
+    ranges), raises 416 when the range starts beyond the end of the file.
+    """
+    if not range_header or size is None:
+        return None
+
+    unit, _, ranges = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in ranges:
+        # Multiple ranges are not supported, RFC 9110 allows sending the full body instead
+        return None
+
+    start_str, sep, end_str = ranges.strip().partition('-')
+    try:
+        if not sep:
+            raise ValueError(range_header)
+        if start_str:
+            start = int(start_str)
+            end = int(end_str) if end_str else size - 1
+            if end_str and end < start:
+                # Syntactically invalid, RFC 9110 says to ignore it
+                return None
+        else:
+            # Suffix range: last N bytes
+            start = max(size - int(end_str), 0)
+            end = size - 1
+    except ValueError:
+        return None
+
+    end = min(end, size - 1)
+    if start >= size:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"}
+        )
+    return start, end
+
+
+async def iter_media(
+        client: TelegramClient,
+        message: Message,
+        start: int = 0,
+        end: Optional[int] = None
+) -> AsyncIterator[bytes]:
+    """Stream message media from Telegram, optionally limited to inclusive byte range"""
+    media = message.photo or message.document
+    aligned_start = start - start % DOWNLOAD_PART_SIZE
+    skip = start - aligned_start
+
+    remaining = None
+    parts = None
+    if end is not None:
+        remaining = end - start + 1
+        parts = (end + 1 - aligned_start + DOWNLOAD_PART_SIZE - 1) // DOWNLOAD_PART_SIZE
+
+    async for chunk in client.iter_download(
+            media,
+            offset=aligned_start,
+            limit=parts,
+            request_size=DOWNLOAD_PART_SIZE
+    ):
+        if skip:
+            chunk = chunk[skip:]
+            skip = 0
+        if remaining is not None:
+            chunk = chunk[:remaining]
+            remaining -= len(chunk)
+        if chunk:
+            yield chunk
+        if remaining is not None and remaining <= 0:
+            break
+
+
+def media_cache_key(message: Message) -> Optional[str]:
+    """Key of message media in the cache: Telegram file id plus photo size type"""
+    if message.photo:
+        sizes = message.photo.sizes
+        return f"photo_{message.photo.id}_{sizes[-1].type}" if sizes else None
+    if message.document:
+        return f"document_{message.document.id}"
+    return None
+
+
+class MediaCache:
+    """Size-bounded LRU cache of downloaded media files on local disk.
+
+    Files are written to a temporary name and renamed when complete, so a
+    cached file is never partial. Concurrent requests for the same missing
+    file wait for a single download. Files being sent are leased and not
+    evicted until their response ends.
+    """
+
+    def __init__(self, directory: Optional[str], max_bytes: int, max_file_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self._files: OrderedDict[str, int] = OrderedDict()
+        self._downloads: dict[str, asyncio.Task] = {}
+        # Responses still sending each file
+        self._leases: dict[str, int] = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.evictions = 0
+        if directory:
+            self._scan()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+
+    def _scan(self):
+        # Media of private chats, only the owner may list and read it
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            if '.tmp-' in entry.name:
+                # Leftover of interrupted download
+                os.remove(entry.path)
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._files[name] = size
+            self.total_bytes += size
+        self._evict()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def accepts(self, size: Optional[int]) -> bool:
+        return self.enabled and size is not None and size <= self.max_file_bytes
+
+    async def file_response(self, key: str, download: Callable[[], AsyncIterator[bytes]],
+                            **kwargs) -> FileResponse:
+        """FileResponse of the cached file, downloading it first if necessary"""
+        path = await self.get_path(key, download)
+        return CachedFileResponse(self, key, path, **kwargs)
+
+    async def get_path(self, key: str, download: Callable[[], AsyncIterator[bytes]]) -> str:
+        """Return path of cached file, downloading it first if necessary.
+
+        The file is leased: it stays on disk until ``release(key)``.
+        """
+        size = self._files.get(key)
+        if size is not None and os.path.exists(self._path(key)):
+            self.hits += 1
+            self.bytes_saved += size
+            self._files.move_to_end(key)
+            return self._lease(key)
+
+        self.misses += 1
+        while True:
+            task = self._downloads.get(key)
+            if task is None:
+                task = asyncio.get_running_loop().create_task(self._download(key, download))
+                self._downloads[key] = task
+                task.add_done_callback(lambda t: self._downloads.pop(key, None))
+            await asyncio.shield(task)
+            # Another download may have evicted the file before this waiter resumed
+            if key in self._files:
+                return self._lease(key)
+
+    def _lease(self, key: str) -> str:
+        self._leases[key] = self._leases.get(key, 0) + 1
+        return self._path(key)
+
+    def release(self, key: str):
+        count = self._leases.get(key, 0) - 1
+        if count > 0:
+            self._leases[key] = count
+        else:
+            self._leases.pop(key, None)
+            # Catch up on evictions skipped while the file was sent
+            self._evict()
+
+    async def _download(self, key: str, download: Callable[[], AsyncIterator[bytes]]) -> str:
+        path = self._path(key)
+        tmp_path = f"{path}.tmp-{uuid.uuid4().hex}"
+        size = 0
+        try:
+            async with aiofiles.open(tmp_path, 'wb') as f:
+                async for chunk in download():
+                    await f.write(chunk)
+                    size += len(chunk)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        old_size = self._files.pop(key, None)
+        if old_size is not None:
+            self.total_bytes -= old_size
+        self._files[key] = size
+        self.total_bytes += size
+        self._evict(keep=key)
+        return path
+
+    def _evict(self, keep: Optional[str] = None):
+        for key, size in list(self._files.items()):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if key == keep or key in self._leases:
+                continue
+            del self._files[key]
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "files": len(self._files),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / requests if requests else 0.0,
+            "bytes_saved": self.bytes_saved,
+            "evictions": self.evictions,
+            "leased": len(self._leases),
+        }
+
+
+class CachedFileResponse(FileResponse):
+    """FileResponse of a media cache file, released once sent or aborted"""
+
+    def __init__(self, cache: MediaCache, key: str, path: str, **kwargs):
+        super().__init__(path, **kwargs)
+        self.cache = cache
+        self.key = key
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.cache.release(self.key)
+
+
+media_cache = MediaCache(MEDIA_CACHE_DIR, MEDIA_CACHE_MAX_BYTES, MEDIA_CACHE_MAX_FILE_BYTES)
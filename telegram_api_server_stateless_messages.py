@@ -1,23 +1,48 @@
-from typing import Optional, List
-from fastapi import APIRouter, HTTPException, Header, UploadFile, File, Form
-from pydantic import BaseModel
-import aiofiles
+import asyncio
 import os
-import mimetypes
+from typing import Dict, Optional, List
+from fastapi import APIRouter, HTTPException, Header, Query, Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
 from datetime import datetime
 from telethon.errors import (
+    FloodWaitError,
     MessageIdInvalidError,
     MessageDeleteForbiddenError,
     MessageEmptyError,
     MessageTooLongError,
     MessageAuthorRequiredError,
-    MessageNotModifiedError
+    MessageNotModifiedError,
+    FileReferenceExpiredError,
+    FileReferenceInvalidError,
+    MediaEmptyError
 )
 from telethon.tl.types import InputMediaUploadedDocument, DocumentAttributeFilename
-from telegram_api_server_stateless_utils import get_client_from_session
+from telethon.utils import get_peer_id
+from telegram_api_server_stateless_json import FAST_JSON, FastJSONResponse
+from telegram_api_server_stateless_models import MessageInfo, build_message_info
+from telegram_api_server_stateless_peers import peer_cache, resolve_peer
+from telegram_api_server_stateless_ratelimit import flood_wait_error
+from telegram_api_server_stateless_scheduler import bulk_priority
+from telegram_api_server_stateless_store import message_store
+from telegram_api_server_stateless_uploads import SEND_WITH_FILE_OPENAPI, receive_upload, upload_cache
+from telegram_api_server_stateless_utils import get_client_from_session, pinned_stream
 
 router = APIRouter(prefix="/messages", tags=["messages"])
 
+# Telegram deletes at most 100 messages per request
+DELETE_BATCH_SIZE = 100
+# Delete requests of one call sent to Telegram at the same time
+DELETE_CONCURRENCY = 3
+# Messages of one /send_batch call sent at the same time
+BATCH_SEND_CONCURRENCY = int(os.getenv("BATCH_SEND_CONCURRENCY", "5"))
+# Flood waits in /send_batch are waited out this many times per chat, if not longer than max wait
+BATCH_FLOOD_RETRIES = int(os.getenv("BATCH_FLOOD_RETRIES", "3"))
+BATCH_FLOOD_MAX_WAIT = int(os.getenv("BATCH_FLOOD_MAX_WAIT", "300"))
+# Chats of one /multi call read at the same time, and most chats per call
+MULTI_CHAT_CONCURRENCY = int(os.getenv("MULTI_CHAT_CONCURRENCY", "10"))
+MULTI_CHAT_MAX = int(os.getenv("MULTI_CHAT_MAX", "100"))
+
 class SendMessageRequest(BaseModel):
     chat_id: str
     text: str
@@ -37,6 +62,31 @@ class SendMessageResponse(BaseModel):
     success: bool
     message_id: int
     date: datetime
+    file_sha256: Optional[str] = None
+
+class SendBatchRequest(BaseModel):
+    chat_ids: List[str]
+    text: Optional[str] = None
+    # SHA-256 of a file already sent with /messages/send_with_file
+    file_sha256: Optional[str] = None
+
+class BatchSendResult(BaseModel):
+    chat_id: str
+    success: bool
+    message_id: Optional[int] = None
+    date: Optional[datetime] = None
+    error: Optional[str] = None
+    wait_seconds: Optional[int] = None
+
+class ChatMessagesResult(BaseModel):
+    success: bool
+    messages: List[MessageInfo] = []
+    error: Optional[str] = None
+    wait_seconds: Optional[int] = None
+
+class MultiMessagesResponse(BaseModel):
+    # Keyed by chat_id as it was passed in the request
+    results: Dict[str, ChatMessagesResult]
 
 class DeleteMessageRequest(BaseModel):
     chat_id: str
@@ -46,9 +96,11 @@ class DeleteMessageResponse(BaseModel):
     success: bool
     deleted_messages: List[int]
 
-# Создаем временную директорию для загрузки файлов
-UPLOAD_DIR = "temp_uploads"
-os.makedirs(UPLOAD_DIR, exist_ok=True)
+async def _send_to_chat(client, chat_id: str, text: Optional[str], reply_to: Optional[int] = None, media=None):
+    entity = await resolve_peer(client, chat_id)
+    if media is not None:
+        return await client.send_file(entity=entity, file=media, caption=text, reply_to=reply_to)
+    return await client.send_message(entity=entity, message=text, reply_to=reply_to)
 
 @router.post("/send", response_model=SendMessageResponse)
 async def send_message(
@@ -59,11 +111,8 @@ async def send_message(
     try:
         client = await get_client_from_session(session_string)
 
-        entity = await client.get_input_entity(message.chat_id)
-        sent_message = await client.send_message(
-            entity=entity,
-            message=message.text,
-            reply_to=message.reply_to_message_id
+        sent_message = await _send_to_chat(
+            client, message.chat_id, message.text, reply_to=message.reply_to_message_id
         )
 
         return SendMessageResponse(
@@ -75,61 +124,181 @@ async def send_message(
         raise HTTPException(status_code=400, detail="Message text cannot be empty")
     except MessageTooLongError:
         raise HTTPException(status_code=400, detail="Message text is too long")
+    except FloodWaitError as e:
+        raise flood_wait_error(e)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
-@router.post("/send_with_file", response_model=SendMessageResponse)
+@router.post("/send_with_file", response_model=SendMessageResponse, openapi_extra=SEND_WITH_FILE_OPENAPI)
 async def send_message_with_file(
-        chat_id: str = Form(...),
-        text: Optional[str] = Form(None),
-        reply_to_message_id: Optional[int] = Form(None),
-        file: UploadFile = File(...),
-        session_string: str = Header(..., alias="X-Session-String")
+        request: Request,
+        session_string: str = Header(..., alias="X-Session-String"),
+        file_sha256: Optional[str] = Header(None, alias="X-File-SHA256")
 ):
-    """Send message with file attachment"""
+    """Send message with file attachment.
+
+    If X-File-SHA256 matches a file this session has already sent, the
+    Telegram document is reused and the file is not uploaded again.
+    """
     try:
         client = await get_client_from_session(session_string)
 
-        # Сохраняем файл временно
-        file_path = os.path.join(UPLOAD_DIR, file.filename)
+        cached_media = upload_cache.get(client.session_key, file_sha256) if file_sha256 else None
+
+        # Файл загружается в Telegram по частям прямо из тела запроса, без временных файлов
+        form = await receive_upload(request, client, upload=cached_media is None)
+        chat_id = form.fields.get("chat_id")
+        if not chat_id:
+            raise HTTPException(status_code=422, detail="Field chat_id is required")
+        if form.sha256 is None:
+            raise HTTPException(status_code=422, detail="Field file is required")
+        if cached_media is not None and form.sha256 != file_sha256.lower():
+            raise HTTPException(status_code=400, detail="File content does not match X-File-SHA256")
+        text = form.fields.get("text")
+        reply_to_message_id = form.fields.get("reply_to_message_id")
+        reply_to_message_id = int(reply_to_message_id) if reply_to_message_id else None
+
+        # Отправляем файл
+        entity = await resolve_peer(client, chat_id)
         try:
-            async with aiofiles.open(file_path, 'wb') as f:
-                content = await file.read()
-                await f.write(content)
-
-            # Определяем MIME-тип файла по расширению
-            mime_type, _ = mimetypes.guess_type(file.filename)
-            if mime_type is None:
-                mime_type = 'application/octet-stream'  # дефолтный тип если не удалось определить
-
-            # Отправляем файл
-            entity = await client.get_input_entity(chat_id)
             sent_message = await client.send_file(
                 entity=entity,
-                file=file_path,
+                file=cached_media or form.file,
                 caption=text,
                 reply_to=reply_to_message_id,
-                attributes=[DocumentAttributeFilename(file_name=file.filename)]
+                attributes=[DocumentAttributeFilename(file_name=form.file_name)],
+                # Большие файлы не могут быть отправлены как фото
+                force_document=form.big
             )
-
-            return SendMessageResponse(
-                success=True,
-                message_id=sent_message.id,
-                date=sent_message.date
+        except (FileReferenceExpiredError, FileReferenceInvalidError, MediaEmptyError):
+            if cached_media is None:
+                raise
+            upload_cache.discard(client.session_key, form.sha256)
+            raise HTTPException(
+                status_code=409,
+                detail="Cached file is no longer available, send it again without X-File-SHA256"
             )
 
-        finally:
-            # Удаляем временный файл
-            if os.path.exists(file_path):
-                os.remove(file_path)
+        if cached_media is not None:
+            upload_cache.bytes_saved += form.file_size
+        elif sent_message.media is not None:
+            upload_cache.put(client.session_key, form.sha256, sent_message.media)
+
+        return SendMessageResponse(
+            success=True,
+            message_id=sent_message.id,
+            date=sent_message.date,
+            file_sha256=form.sha256
+        )
 
     except MessageEmptyError:
         raise HTTPException(status_code=400, detail="Message caption cannot be empty")
     except MessageTooLongError:
         raise HTTPException(status_code=400, detail="Message caption is too long")
+    except HTTPException:
+        raise
+    except FloodWaitError as e:
+        raise flood_wait_error(e)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+async def _send_batch_item(client, chat_id: str, batch: SendBatchRequest, media,
+                           slots: asyncio.Semaphore) -> BatchSendResult:
+    """Send one message of the batch, waiting out flood waits up to BATCH_FLOOD_RETRIES times"""
+    attempt = 0
+    while True:
+        try:
+            async with slots:
+                sent_message = await _send_to_chat(client, chat_id, batch.text, media=media)
+            return BatchSendResult(
+                chat_id=chat_id,
+                success=True,
+                message_id=sent_message.id,
+                date=sent_message.date
+            )
+        except FloodWaitError as e:
+            attempt += 1
+            if attempt > BATCH_FLOOD_RETRIES or e.seconds > BATCH_FLOOD_MAX_WAIT:
+                return BatchSendResult(chat_id=chat_id, success=False, error=str(e), wait_seconds=e.seconds)
+            await asyncio.sleep(e.seconds)
+        except Exception as e:
+            return BatchSendResult(chat_id=chat_id, success=False, error=str(e))
+
+
+@router.post("/send_batch")
+async def send_batch(
+        batch: SendBatchRequest,
+        session_string: str = Header(..., alias="X-Session-String")
+):
+    """Send the same message to many chats.
+
+    Results are streamed as NDJSON, one BatchSendResult line per chat in
+    the order the sends complete.
+    """
+    client = await get_client_from_session(session_string)
+
+    media = None
+    if batch.file_sha256:
+        media = upload_cache.get(client.session_key, batch.file_sha256)
+        if media is None:
+            raise HTTPException(
+                status_code=404,
+                detail="File not found, send it with /messages/send_with_file first"
+            )
+    elif not batch.text:
+        raise HTTPException(status_code=400, detail="Message text cannot be empty")
+
+    chat_ids = list(dict.fromkeys(batch.chat_ids))
+    slots = asyncio.Semaphore(BATCH_SEND_CONCURRENCY)
+
+    async def results():
+        # Tasks inherit the priority, the sends yield to interactive requests of other sessions
+        with bulk_priority():
+            tasks = [
+                asyncio.ensure_future(_send_batch_item(client, chat_id, batch, media, slots))
+                for chat_id in chat_ids
+            ]
+        try:
+            for task in asyncio.as_completed(tasks):
+                result = await task
+                yield result.model_dump_json() + "\n"
+        finally:
+            # Клиент отключился - отменяем оставшиеся отправки
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(pinned_stream(session_string, results()), media_type="application/x-ndjson")
+
+
+async def _delete_chunk(client, entity, message_ids: List[int], slots: asyncio.Semaphore) -> List[int]:
+    """Delete chunk of messages with one request and return ids that are gone.
+
+    A chunk rejected by Telegram is split in halves to skip the messages
+    that can not be deleted.
+    """
+    try:
+        async with slots:
+            affected = await client.delete_messages(entity, message_ids)
+    except (MessageIdInvalidError, MessageDeleteForbiddenError, MessageAuthorRequiredError):
+        # Пропускаем сообщения, которые нельзя удалить
+        if len(message_ids) == 1:
+            return []
+        middle = len(message_ids) // 2
+        halves = await asyncio.gather(
+            _delete_chunk(client, entity, message_ids[:middle], slots),
+            _delete_chunk(client, entity, message_ids[middle:], slots)
+        )
+        return halves[0] + halves[1]
+
+    if sum(result.pts_count for result in affected) == len(message_ids):
+        return message_ids
+
+    # Telegram only reports how many messages were deleted, check which are still there
+    async with slots:
+        remaining = await client.get_messages(entity, ids=message_ids)
+    return [message_id for message_id, message in zip(message_ids, remaining) if message is None]
+
+
 @router.delete("/delete", response_model=DeleteMessageResponse)
 async def delete_messages(
         delete_request: DeleteMessageRequest,
@@ -139,20 +308,16 @@ async def delete_messages(
     try:
         client = await get_client_from_session(session_string)
 
-        entity = await client.get_input_entity(delete_request.chat_id)
-
-        # Пытаемся удалить сообщения
-        deleted_messages = []
-        for message_id in delete_request.message_ids:
-            try:
-                await client.delete_messages(entity, message_id)
-                deleted_messages.append(message_id)
-            except MessageIdInvalidError:
-                continue  # Пропускаем некорректные ID сообщений
-            except MessageDeleteForbiddenError:
-                continue  # Пропускаем сообщения, которые нельзя удалить
-            except MessageAuthorRequiredError:
-                continue  # Пропускаем сообщения, для удаления которых нужны права автора
+        entity = await resolve_peer(client, delete_request.chat_id)
+
+        # Удаляем сообщения пачками по DELETE_BATCH_SIZE за один запрос
+        message_ids = list(dict.fromkeys(delete_request.message_ids))
+        slots = asyncio.Semaphore(DELETE_CONCURRENCY)
+        chunks = await asyncio.gather(*(
+            _delete_chunk(client, entity, message_ids[i:i + DELETE_BATCH_SIZE], slots)
+            for i in range(0, len(message_ids), DELETE_BATCH_SIZE)
+        ))
+        deleted_messages = [message_id for chunk in chunks for message_id in chunk]
 
         if not deleted_messages:
             raise HTTPException(
@@ -165,6 +330,8 @@ async def delete_messages(
             deleted_messages=deleted_messages
         )
 
+    except FloodWaitError as e:
+        raise flood_wait_error(e)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -178,8 +345,8 @@ async def forward_message(
         client = await get_client_from_session(session_string)
 
         # Получаем исходный и целевой чаты
-        from_entity = await client.get_input_entity(forward_request.from_chat_id)
-        to_entity = await client.get_input_entity(forward_request.to_chat_id)
+        from_entity = await resolve_peer(client, forward_request.from_chat_id)
+        to_entity = await resolve_peer(client, forward_request.to_chat_id)
 
         # Пересылаем сообщение
         forwarded_message = await client.forward_messages(
@@ -196,6 +363,8 @@ async def forward_message(
 
     except MessageIdInvalidError:
         raise HTTPException(status_code=400, detail="Invalid message ID")
+    except FloodWaitError as e:
+        raise flood_wait_error(e)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -208,7 +377,7 @@ async def edit_message(
     try:
         client = await get_client_from_session(session_string)
 
-        entity = await client.get_input_entity(edit_request.chat_id)
+        entity = await resolve_peer(client, edit_request.chat_id)
 
         # Редактируем сообщение
         edited_message = await client.edit_message(
@@ -233,5 +402,65 @@ async def edit_message(
         raise HTTPException(status_code=400, detail="New message text is too long")
     except MessageAuthorRequiredError:
         raise HTTPException(status_code=403, detail="You must be the author of the message to edit it")
+    except FloodWaitError as e:
+        raise flood_wait_error(e)
     except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=400, detail=str(e))
+
+async def _latest_messages(client, chat_id: str, limit: int, slots: asyncio.Semaphore) -> ChatMessagesResult:
+    """Last messages of one chat for /multi; errors are returned instead of raised"""
+    try:
+        async with slots:
+            entity = await resolve_peer(client, chat_id)
+            if message_store.enabled:
+                stored = await message_store.read(client, entity, limit)
+                if stored is not None:
+                    return ChatMessagesResult(success=True, messages=stored)
+            messages = await client.get_messages(entity, limit=limit)
+
+        peer_cache.remember_entities(
+            client.session_key,
+            (peer for msg in messages for peer in (msg.sender, msg.chat))
+        )
+        messages_list = [build_message_info(msg) for msg in messages]
+        if message_store.enabled:
+            await message_store.save_page(
+                client.session_key, get_peer_id(entity), messages_list, 0, len(messages) < limit
+            )
+        return ChatMessagesResult(success=True, messages=messages_list)
+    except FloodWaitError as e:
+        return ChatMessagesResult(success=False, error=str(e), wait_seconds=e.seconds)
+    except ValueError as e:
+        return ChatMessagesResult(success=False, error=f"Chat not found: {str(e)}")
+    except Exception as e:
+        return ChatMessagesResult(success=False, error=str(e))
+
+
+@router.get("/multi", response_model=MultiMessagesResponse)
+async def get_multi_chat_messages(
+        chat_id: List[str] = Query(...),
+        limit: int = 20,
+        session_string: str = Header(..., alias="X-Session-String")
+):
+    """Last messages of many chats at once.
+
+    Chats are read concurrently (at most MULTI_CHAT_CONCURRENCY at a time,
+    within the session rate limits). A chat that fails gets success=false
+    and its error, the other chats are not affected.
+    """
+    chat_ids = list(dict.fromkeys(chat_id))
+    if len(chat_ids) > MULTI_CHAT_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {MULTI_CHAT_MAX} chats can be read at once")
+
+    client = await get_client_from_session(session_string)
+
+    slots = asyncio.Semaphore(MULTI_CHAT_CONCURRENCY)
+    with bulk_priority():
+        results = await asyncio.gather(*(
+            _latest_messages(client, chat, limit, slots) for chat in chat_ids
+        ))
+    results = dict(zip(chat_ids, results))
+
+    if FAST_JSON:
+        return FastJSONResponse({"results": results})
+    return MultiMessagesResponse(results=results)
@@ -0,0 +1,146 @@
+from datetime import datetime
+from typing import List, Optional
+
+from pydantic import BaseModel
+from telethon.tl.types import Channel, Chat, User
+from telethon.utils import get_peer_id
+
+
+class MessageInfo(BaseModel):
+    id: int
+    text: Optional[str]
+    date: datetime
+    sender_id: Optional[int]
+    sender_username: Optional[str]
+    sender_name: Optional[str]
+    reply_to_msg_id: Optional[int] = None
+    forward_from: Optional[str] = None
+    media_type: Optional[str] = None
+    is_pinned: Optional[bool] = False
+
+
+def _media_type(msg) -> Optional[str]:
+    if msg.photo:
+        return "photo"
+    elif msg.video:
+        return "video"
+    elif msg.document:
+        return "document"
+    elif msg.voice:
+        return "voice"
+    elif msg.audio:
+        return "audio"
+    return None
+
+
+def _sender_name(msg) -> Optional[str]:
+    if not msg.sender:
+        return None
+    # У каналов вместо имени есть только title
+    sender_name = getattr(msg.sender, 'first_name', None) or getattr(msg.sender, 'title', None)
+    if sender_name and getattr(msg.sender, 'last_name', None):
+        sender_name += f" {msg.sender.last_name}"
+    return sender_name
+
+
+def _forward_from(msg) -> Optional[str]:
+    if msg.forward:
+        if msg.forward.from_name:
+            return msg.forward.from_name
+        elif msg.forward.sender:
+            return getattr(msg.forward.sender, 'username', None) or \
+                   getattr(msg.forward.sender, 'first_name', None)
+    return None
+
+
+# How every MessageInfo field is read from a Telethon message; only requested ones are called
+_MESSAGE_FIELD_GETTERS = {
+    "id": lambda msg: msg.id,
+    "text": lambda msg: msg.text if msg.text else None,
+    "date": lambda msg: msg.date,
+    "sender_id": lambda msg: msg.sender.id if msg.sender else None,
+    "sender_username": lambda msg: getattr(msg.sender, 'username', None) if msg.sender else None,
+    "sender_name": _sender_name,
+    "reply_to_msg_id": lambda msg: msg.reply_to_msg_id,
+    "forward_from": _forward_from,
+    "media_type": _media_type,
+    "is_pinned": lambda msg: msg.pinned,
+}
+
+MESSAGE_FIELDS = tuple(MessageInfo.model_fields)
+
+# Fields that need the sender entity of a message
+SENDER_FIELDS = frozenset({"sender_id", "sender_username", "sender_name"})
+
+
+def parse_message_fields(fields: Optional[str]) -> Optional[tuple[str, ...]]:
+    """Parse comma separated field list, None means all fields"""
+    if not fields:
+        return None
+    selected = tuple(dict.fromkeys(field.strip() for field in fields.split(",") if field.strip()))
+    unknown = [field for field in selected if field not in _MESSAGE_FIELD_GETTERS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}. Available: {', '.join(MESSAGE_FIELDS)}")
+    return selected
+
+
+def build_message_info(msg) -> MessageInfo:
+    return MessageInfo(**{field: getter(msg) for field, getter in _MESSAGE_FIELD_GETTERS.items()})
+
+
+def build_message_fields(msg, fields: tuple[str, ...]) -> dict:
+    """Only the requested fields of a message, without building a whole MessageInfo"""
+    return {field: _MESSAGE_FIELD_GETTERS[field](msg) for field in fields}
+
+
+class ChatInfo(BaseModel):
+    name: str
+    id: int
+    type: str
+    members_count: Optional[int] = None
+    is_private: bool
+    username: Optional[str] = None
+
+
+def build_chat_info(entity, name: str) -> Optional[ChatInfo]:
+    # Determine chat type
+    if isinstance(entity, Channel):
+        chat_type = "channel" if entity.broadcast else "supergroup"
+    elif isinstance(entity, Chat):
+        chat_type = "group"
+    elif isinstance(entity, User):
+        chat_type = "private"
+    else:
+        return None
+
+    return ChatInfo(
+        name=name,
+        id=get_peer_id(entity),
+        type=chat_type,
+        members_count=getattr(entity, 'participants_count', None),
+        is_private=not hasattr(entity, 'username') or entity.username is None,
+        username=getattr(entity, 'username', None)
+    )
+
+
+class ChangedMessage(BaseModel):
+    chat_id: Optional[int]
+    message: MessageInfo
+
+
+class DeletedMessages(BaseModel):
+    # Telegram does not tell the chat of deletions outside channels
+    chat_id: Optional[int]
+    message_ids: List[int]
+
+
+class ChangesResponse(BaseModel):
+    new_messages: List[ChangedMessage]
+    edited_messages: List[ChangedMessage]
+    deleted_messages: List[DeletedMessages]
+    # Channels with changes that are only available through their own chat_id
+    changed_channels: List[int]
+    token: str
+    has_more: bool
+    # Too many changes happened, history has to be loaded again with /messages/
+    reset: bool = False
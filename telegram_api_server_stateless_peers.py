@@ -0,0 +1,294 @@
+import asyncio
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterable, Optional
+
+from telethon import TelegramClient, utils
+from telethon.tl.types import (
+    InputPeerChannel,
+    InputPeerChat,
+    InputPeerSelf,
+    InputPeerUser,
+    TypeInputPeer,
+)
+
+# Peer cache limits (override through environment variables)
+PEER_CACHE_MAX_SIZE = int(os.getenv("PEER_CACHE_MAX_SIZE", "100000"))
+PEER_CACHE_TTL = float(os.getenv("PEER_CACHE_TTL", str(7 * 24 * 3600)))
+# Seconds a numeric chat id missing from the dialogs is not looked up again
+PEER_CACHE_NEGATIVE_TTL = float(os.getenv("PEER_CACHE_NEGATIVE_TTL", "60"))
+# Path to SQLite file; the cache is kept in memory only when not set
+PEER_CACHE_DB = os.getenv("PEER_CACHE_DB")
+
+# Sessions remembered as read from SQLite; the least recently loaded are read again when needed
+_MAX_LOADED_SESSIONS = 10000
+
+
+def _peer_to_row(peer: TypeInputPeer) -> Optional[tuple[str, int, int]]:
+    if isinstance(peer, InputPeerChannel):
+        return "channel", peer.channel_id, peer.access_hash
+    if isinstance(peer, InputPeerUser):
+        return "user", peer.user_id, peer.access_hash
+    if isinstance(peer, InputPeerChat):
+        return "chat", peer.chat_id, 0
+    return None
+
+
+def _row_to_peer(peer_type: str, peer_id: int, access_hash: int) -> TypeInputPeer:
+    if peer_type == "channel":
+        return InputPeerChannel(channel_id=peer_id, access_hash=access_hash)
+    if peer_type == "user":
+        return InputPeerUser(user_id=peer_id, access_hash=access_hash)
+    return InputPeerChat(chat_id=peer_id)
+
+
+def normalize_chat_key(chat_id) -> str:
+    """Cache key for chat identifier: marked numeric id or lowercase username"""
+    key = str(chat_id).strip()
+    for prefix in ("https://t.me/", "http://t.me/", "t.me/", "@"):
+        if key.startswith(prefix):
+            key = key[len(prefix):]
+    return key.lower()
+
+
+class PeerCache:
+    """Per-session cache of chat identifiers to InputPeer with real access_hash.
+
+    Entries expire after ``ttl`` seconds, the least recently used ones are
+    dropped above ``max_size``. When ``db_path`` is set, entries are also
+    stored in SQLite so a restarted server does not resolve everything again.
+    SQLite runs on a thread of its own: a session's stored entries are read
+    once with ``load`` and writes are queued without being waited for.
+    Chat ids that could not be found are remembered for ``negative_ttl``.
+    """
+
+    def __init__(self, max_size: int, ttl: float, db_path: Optional[str] = None,
+                 negative_ttl: float = PEER_CACHE_NEGATIVE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries: OrderedDict[tuple[str, str], tuple[TypeInputPeer, float]] = OrderedDict()
+        self._missing: OrderedDict[tuple[str, str], float] = OrderedDict()
+        # Sessions whose stored entries are in memory, dropped when one of their entries is evicted
+        self._loaded_sessions: OrderedDict[str, None] = OrderedDict()
+        self._loading: dict[str, asyncio.Future] = {}
+        self._db: Optional[sqlite3.Connection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.write_errors = 0
+        if db_path:
+            self._open_db(db_path)
+
+    def _open_db(self, db_path: str):
+        # Tells which chats each session talks to, only the owner may read it
+        os.close(os.open(db_path, os.O_CREAT | os.O_RDWR, 0o600))
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS peers ("
+            "session_key TEXT NOT NULL, key TEXT NOT NULL, peer_type TEXT NOT NULL, "
+            "peer_id INTEGER NOT NULL, access_hash INTEGER NOT NULL, expires REAL NOT NULL, "
+            "PRIMARY KEY (session_key, key))"
+        )
+        self._db.execute("DELETE FROM peers WHERE expires < ?", (time.time(),))
+        self._db.commit()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="peer-cache")
+
+    async def load(self, session_key: str):
+        """Read the stored entries of a session into memory, if not done yet"""
+        if self._db is None or session_key in self._loaded_sessions:
+            return
+        task = self._loading.get(session_key)
+        if task is None:
+            task = asyncio.ensure_future(self._load_session(session_key))
+            self._loading[session_key] = task
+            task.add_done_callback(lambda t: self._loading.pop(session_key, None))
+        await asyncio.shield(task)
+
+    async def _load_session(self, session_key: str):
+        rows = await asyncio.get_running_loop().run_in_executor(self._executor, self._select, session_key)
+        now = time.time()
+        for key, peer_type, peer_id, access_hash, expires in rows:
+            # Entries put while the rows were read are newer
+            if (session_key, key) not in self._entries:
+                self._store(session_key, key, _row_to_peer(peer_type, peer_id, access_hash),
+                            time.monotonic() + (expires - now))
+        self._loaded_sessions[session_key] = None
+        while len(self._loaded_sessions) > _MAX_LOADED_SESSIONS:
+            self._loaded_sessions.popitem(last=False)
+
+    def _select(self, session_key: str) -> list[tuple]:
+        return self._db.execute(
+            "SELECT key, peer_type, peer_id, access_hash, expires FROM peers "
+            "WHERE session_key = ? AND expires >= ?",
+            (session_key, time.time()),
+        ).fetchall()
+
+    def _store(self, session_key: str, key: str, peer: TypeInputPeer, expires: float):
+        self._entries[(session_key, key)] = (peer, expires)
+        self._entries.move_to_end((session_key, key))
+        while len(self._entries) > self.max_size:
+            (evicted_session, _), _ = self._entries.popitem(last=False)
+            # The evicted entry is still in SQLite, read the session again on its next lookup
+            self._loaded_sessions.pop(evicted_session, None)
+
+    def get(self, session_key: str, chat_id) -> Optional[TypeInputPeer]:
+        """Cached peer from memory; call ``load`` for the session first"""
+        cache_key = (session_key, normalize_chat_key(chat_id))
+        entry = self._entries.get(cache_key)
+        if entry is None or entry[1] < time.monotonic():
+            if entry is not None:
+                del self._entries[cache_key]
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(cache_key)
+        return entry[0]
+
+    def put(self, session_key: str, keys: Iterable, peer: TypeInputPeer):
+        """Remember peer under each of the given chat identifiers"""
+        self.put_many(session_key, [(keys, peer)])
+
+    def put_many(self, session_key: str, items: Iterable[tuple[Iterable, TypeInputPeer]]):
+        """Remember (chat identifiers, peer) pairs with a single SQLite transaction.
+
+        Entries already holding the same peer are only rewritten in their
+        second half of life, so refreshing dialogs writes almost nothing.
+        """
+        now = time.monotonic()
+        expires = now + self.ttl
+        rows = []
+        for keys, peer in items:
+            row = _peer_to_row(peer)
+            if row is None:
+                continue
+            for key in {normalize_chat_key(key) for key in keys if key}:
+                cache_key = (session_key, key)
+                self._missing.pop(cache_key, None)
+                entry = self._entries.get(cache_key)
+                if entry is not None and entry[1] - now > self.ttl / 2 and _peer_to_row(entry[0]) == row:
+                    self._entries.move_to_end(cache_key)
+                    continue
+                self._store(session_key, key, peer, expires)
+                rows.append((session_key, key, *row))
+
+        if self._db is not None and rows:
+            db_expires = time.time() + self.ttl
+            future = self._executor.submit(self._write, [(*row, db_expires) for row in rows])
+            future.add_done_callback(self._write_done)
+
+    def _write(self, rows: list[tuple]):
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO peers VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def _write_done(self, future: Future):
+        # Memory is already current, a lost write only costs a lookup after a restart
+        if future.exception() is not None:
+            self.write_errors += 1
+
+    def remember_entities(self, session_key: str, entities: Iterable):
+        """Fill cache from User/Chat/Channel objects returned by Telegram"""
+        items = []
+        for entity in entities:
+            # "min" entities carry an access_hash that is not usable for requests
+            if entity is None or getattr(entity, 'min', False):
+                continue
+            try:
+                peer = utils.get_input_peer(entity, allow_self=False)
+            except TypeError:
+                continue
+            items.append(([utils.get_peer_id(entity), getattr(entity, 'username', None)], peer))
+        self.put_many(session_key, items)
+
+    def is_missing(self, session_key: str, chat_id) -> bool:
+        """Whether chat_id was recently looked up in vain"""
+        cache_key = (session_key, normalize_chat_key(chat_id))
+        expires = self._missing.get(cache_key)
+        if expires is None:
+            return False
+        if expires < time.monotonic():
+            del self._missing[cache_key]
+            return False
+        self.negative_hits += 1
+        return True
+
+    def put_missing(self, session_key: str, chat_id):
+        cache_key = (session_key, normalize_chat_key(chat_id))
+        self._missing[cache_key] = time.monotonic() + self.negative_ttl
+        self._missing.move_to_end(cache_key)
+        while len(self._missing) > self.max_size:
+            self._missing.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "missing": len(self._missing),
+            "negative_hits": self.negative_hits,
+            "persistent": self._db is not None,
+            "loaded_sessions": len(self._loaded_sessions),
+            "write_errors": self.write_errors,
+        }
+
+    def close(self):
+        if self._executor is not None:
+            # Queued writes are finished before the connection goes away
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+peer_cache = PeerCache(PEER_CACHE_MAX_SIZE, PEER_CACHE_TTL, PEER_CACHE_DB)
+
+
+async def resolve_peer(client: TelegramClient, chat_id) -> TypeInputPeer:
+    """Resolve chat id or username to InputPeer, using the shared peer cache.
+
+    Raises ValueError if the chat can not be found.
+    """
+    session_key = getattr(client, 'session_key', None)
+    if session_key is not None:
+        await peer_cache.load(session_key)
+        peer = peer_cache.get(session_key, chat_id)
+        if peer is not None:
+            return peer
+
+    target = str(chat_id).strip()
+    try:
+        target = int(target)
+    except ValueError:
+        pass
+
+    try:
+        peer = await client.get_input_entity(target)
+    except ValueError:
+        if not isinstance(target, int):
+            raise
+        if session_key is None:
+            await client.get_dialogs()
+            return await client.get_input_entity(target)
+        if peer_cache.is_missing(session_key, chat_id):
+            raise ValueError(f"Could not find the input entity for {target}")
+        # Unknown numeric id: access_hash can only be learnt from dialogs, loaded once per client
+        from telegram_api_server_stateless_dialogs import dialog_cache  # imports this module
+        await dialog_cache.get(client)
+        try:
+            peer = await client.get_input_entity(target)
+        except ValueError:
+            peer_cache.put_missing(session_key, chat_id)
+            raise
+
+    if session_key is not None and not isinstance(peer, InputPeerSelf):
+        peer_cache.put(session_key, [chat_id], peer)
+    return peer
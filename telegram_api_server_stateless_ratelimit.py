@@ -0,0 +1,183 @@
+import asyncio
+import math
+import os
+import time
+from typing import Awaitable, Callable, TypeVar
+
+from fastapi import HTTPException
+from telethon.errors import FloodWaitError
+
+# Request rate limits (override through environment variables)
+RATE_LIMIT_SESSION_RPS = float(os.getenv("RATE_LIMIT_SESSION_RPS", "10"))
+RATE_LIMIT_SESSION_BURST = float(os.getenv("RATE_LIMIT_SESSION_BURST", "20"))
+RATE_LIMIT_API_ID_RPS = float(os.getenv("RATE_LIMIT_API_ID_RPS", "30"))
+RATE_LIMIT_API_ID_BURST = float(os.getenv("RATE_LIMIT_API_ID_BURST", "60"))
+# Seconds needed to get back to the full rate after a flood wait
+RATE_LIMIT_RECOVERY = float(os.getenv("RATE_LIMIT_RECOVERY", "300"))
+# Flood waits up to this many seconds are waited out and retried, longer ones are raised
+# and make further requests of the session fail at once until the wait is over
+RATE_LIMIT_FLOOD_RETRY_MAX = float(os.getenv("RATE_LIMIT_FLOOD_RETRY_MAX", "30"))
+
+# The rate never drops below this fraction of the configured one
+_MIN_RATE_FACTOR = 0.05
+# Idle buckets are dropped once there are more than this many
+_MAX_BUCKETS = 10000
+
+T = TypeVar("T")
+
+
+class TokenBucket:
+    """Token bucket that halves its rate on flood wait and recovers linearly"""
+
+    def __init__(self, rate: float, burst: float):
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        elapsed = now - self.updated
+        self.updated = now
+        if self.rate < self.base_rate:
+            self.rate = min(self.base_rate, self.rate + elapsed * self.base_rate / RATE_LIMIT_RECOVERY)
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+
+    def reserve(self) -> float:
+        """Take one token and return how long the caller has to wait for it"""
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= 1
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < 0:
+            wait = max(wait, -self.tokens / self.rate)
+        return wait
+
+    def penalize(self, seconds: float):
+        now = time.monotonic()
+        self._refill(now)
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        self.rate = max(self.base_rate * _MIN_RATE_FACTOR, self.rate / 2)
+        self.tokens = min(self.tokens, 0)
+
+    def is_idle(self) -> bool:
+        now = time.monotonic()
+        self._refill(now)
+        return self.tokens >= self.burst and self.rate >= self.base_rate and self.blocked_until <= now
+
+
+class RateLimiter:
+    """Per-session and per-api_id token buckets shared by all Telegram requests"""
+
+    def __init__(self):
+        self._sessions: dict[str, TokenBucket] = {}
+        self._api_ids: dict[int, TokenBucket] = {}
+        self.throttled = 0
+        self.flood_waits = 0
+        self.flood_retries = 0
+        self.rejected = 0
+
+    def _buckets(self, session_key: str, api_id: int) -> tuple[TokenBucket, TokenBucket]:
+        session_bucket = self._sessions.get(session_key)
+        if session_bucket is None:
+            self._prune(self._sessions)
+            session_bucket = self._sessions[session_key] = TokenBucket(
+                RATE_LIMIT_SESSION_RPS, RATE_LIMIT_SESSION_BURST)
+        api_bucket = self._api_ids.get(api_id)
+        if api_bucket is None:
+            self._prune(self._api_ids)
+            api_bucket = self._api_ids[api_id] = TokenBucket(
+                RATE_LIMIT_API_ID_RPS, RATE_LIMIT_API_ID_BURST)
+        return session_bucket, api_bucket
+
+    @staticmethod
+    def _prune(buckets: dict):
+        if len(buckets) >= _MAX_BUCKETS:
+            for key in [key for key, bucket in buckets.items() if bucket.is_idle()]:
+                del buckets[key]
+
+    def _check_blocked(self, buckets: tuple[TokenBucket, ...]):
+        """Raise FloodWaitError instead of sleeping through a block too long to wait out"""
+        wait = max(bucket.blocked_until for bucket in buckets) - time.monotonic()
+        if wait > RATE_LIMIT_FLOOD_RETRY_MAX:
+            self.rejected += 1
+            raise FloodWaitError(request=None, capture=math.ceil(wait))
+
+    async def acquire(self, session_key: str, api_id: int):
+        buckets = self._buckets(session_key, api_id)
+        self._check_blocked(buckets)
+        wait = max(bucket.reserve() for bucket in buckets)
+        if wait > 0:
+            self.throttled += 1
+            await asyncio.sleep(wait)
+
+    async def wait_unblocked(self, session_key: str, api_id: int):
+        buckets = self._buckets(session_key, api_id)
+        self._check_blocked(buckets)
+        wait = max(bucket.blocked_until for bucket in buckets) - time.monotonic()
+        if wait > 0:
+            self.throttled += 1
+            await asyncio.sleep(wait)
+
+    def penalize(self, session_key: str, api_id: int, seconds: float):
+        """Slow down the session and its api_id after a flood wait that will be retried"""
+        for bucket in self._buckets(session_key, api_id):
+            bucket.penalize(seconds)
+
+    def block(self, session_key: str, seconds: float):
+        """Fail requests of one session for a flood wait too long to retry.
+
+        The api_id bucket is left alone: other sessions of the same api_id
+        are not affected by this session's flood wait.
+        """
+        session_bucket = self._sessions.get(session_key)
+        if session_bucket is not None:
+            session_bucket.penalize(seconds)
+
+    async def run(self, session_key: str, api_id: int, call: Callable[[], Awaitable[T]],
+                  limited: bool = True) -> T:
+        """Run a Telegram request within the rate limits, retrying short flood waits.
+
+        Requests with ``limited=False`` do not take tokens but still respect flood waits.
+        """
+        while True:
+            if limited:
+                await self.acquire(session_key, api_id)
+            else:
+                await self.wait_unblocked(session_key, api_id)
+            try:
+                return await call()
+            except FloodWaitError as e:
+                self.flood_waits += 1
+                if e.seconds > RATE_LIMIT_FLOOD_RETRY_MAX:
+                    self.block(session_key, e.seconds)
+                    raise
+                self.penalize(session_key, api_id, e.seconds)
+                self.flood_retries += 1
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self._sessions),
+            "api_ids": len(self._api_ids),
+            "throttled": self.throttled,
+            "flood_waits": self.flood_waits,
+            "flood_retries": self.flood_retries,
+            "rejected": self.rejected,
+        }
+
+
+def flood_wait_error(e: FloodWaitError) -> HTTPException:
+    """429 response for a flood wait, with Retry-After"""
+    return HTTPException(
+        status_code=429,
+        detail={
+            "error": "Too many requests",
+            "wait_seconds": e.seconds,
+            "message": f"Please wait {e.seconds} seconds before making another request"
+        },
+        headers={"Retry-After": str(e.seconds)}
+    )
+
+
+rate_limiter = RateLimiter()
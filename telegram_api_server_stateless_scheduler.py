@@ -0,0 +1,247 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Literal, TypeVar
+
+T = TypeVar("T")
+
+Priority = Literal["interactive", "bulk"]
+PRIORITIES: tuple[Priority, ...] = ("interactive", "bulk")
+
+# Telegram requests running at once over all sessions; 0 disables scheduling
+SCHEDULER_CONCURRENCY = int(os.getenv("SCHEDULER_CONCURRENCY", "64"))
+# Telegram requests running at once for one session
+SCHEDULER_SESSION_CONCURRENCY = int(os.getenv("SCHEDULER_SESSION_CONCURRENCY", "4"))
+# Part of SCHEDULER_CONCURRENCY bulk requests may take, the rest stays free for interactive ones
+SCHEDULER_BULK_SHARE = float(os.getenv("SCHEDULER_BULK_SHARE", "0.5"))
+# /messages/ pages with more messages than this are scheduled as bulk
+SCHEDULER_BULK_PAGE_SIZE = int(os.getenv("SCHEDULER_BULK_PAGE_SIZE", "200"))
+# Per-session concurrency overrides, "<session fingerprint>:<limit>,..." (see /metrics/clients)
+SCHEDULER_SESSION_LIMITS = {
+    key.strip(): max(1, int(limit))
+    for key, limit in (item.split(":", 1) for item in os.getenv("SCHEDULER_SESSION_LIMITS", "").split(",") if item.strip())
+}
+
+_priority: contextvars.ContextVar[Priority] = contextvars.ContextVar("rpc_priority", default="interactive")
+
+
+@contextmanager
+def bulk_priority():
+    """Telegram requests made inside (and by tasks started inside) are scheduled as bulk"""
+    token = _priority.set("bulk")
+    try:
+        yield
+    finally:
+        try:
+            _priority.reset(token)
+        except ValueError:
+            # Async generator closed from another context, e.g. finalized by the event loop
+            pass
+
+
+def current_priority() -> Priority:
+    return _priority.get()
+
+
+class _Class:
+    """Waiting requests of one priority, served by weighted fair queuing over sessions"""
+
+    def __init__(self):
+        self.queues: dict[str, deque[tuple[float, asyncio.Future]]] = {}
+        # (finish tag of the first waiting request, tie breaker, session) of sessions below their limit
+        self.ready: list[tuple[float, int, str]] = []
+        self.in_ready: set[str] = set()
+        self.last_finish: dict[str, float] = {}
+        self.virtual_time = 0.0
+        self.active = 0
+        self.queued = 0
+
+    def tag(self, session_key: str, weight: float) -> float:
+        start = max(self.virtual_time, self.last_finish.get(session_key, 0.0))
+        finish = self.last_finish[session_key] = start + 1 / weight
+        return finish
+
+
+class FairScheduler:
+    """Shares the concurrent Telegram requests of the process fairly between sessions.
+
+    Every session gets a share proportional to its concurrency limit, so a
+    session issuing hundreds of calls delays the others by at most its own
+    share. Interactive requests are always served before bulk ones, and
+    bulk requests never take more than ``bulk_share`` of all slots.
+    """
+
+    def __init__(self, concurrency: int, session_concurrency: int, bulk_share: float,
+                 session_limits: dict[str, int]):
+        self.concurrency = concurrency
+        self.session_concurrency = session_concurrency
+        self.bulk_limit = max(1, int(concurrency * bulk_share))
+        self.session_limits = session_limits
+        self._classes = {priority: _Class() for priority in PRIORITIES}
+        self._active: dict[str, int] = {}
+        self._order = itertools.count()
+        self.waited = 0
+        self.wait_seconds = 0.0
+
+    def _limit(self, session_key: str) -> int:
+        return self.session_limits.get(session_key, self.session_concurrency)
+
+    def _total_active(self) -> int:
+        return sum(cls.active for cls in self._classes.values())
+
+    def _has_room(self, priority: Priority) -> bool:
+        if self._total_active() >= self.concurrency:
+            return False
+        return priority != "bulk" or self._classes["bulk"].active < self.bulk_limit
+
+    async def run(self, session_key: str, call: Callable[[], Awaitable[T]]) -> T:
+        """Run a Telegram request once the session's fair share allows it"""
+        if self.concurrency <= 0:
+            return await call()
+        priority = current_priority()
+        await self._acquire(session_key, priority)
+        try:
+            return await call()
+        finally:
+            self._release(session_key, priority)
+
+    async def _acquire(self, session_key: str, priority: Priority):
+        cls = self._classes[priority]
+        weight = self._limit(session_key) / self.session_concurrency
+        finish = cls.tag(session_key, weight)
+        waiting = any(self._classes[p].queued for p in PRIORITIES[:PRIORITIES.index(priority) + 1])
+        if not waiting and self._has_room(priority) and self._active.get(session_key, 0) < self._limit(session_key):
+            cls.virtual_time = max(cls.virtual_time, finish - 1 / weight)
+            self._grant(session_key, cls)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        queue = cls.queues.setdefault(session_key, deque())
+        queue.append((finish, future))
+        cls.queued += 1
+        if len(queue) == 1:
+            self._make_ready(session_key, cls)
+        self._dispatch()
+        if future.done():
+            return
+        started = time.monotonic()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Granted just before the cancel: hand the slot on
+                self._release(session_key, priority)
+            else:
+                self._withdraw(session_key, cls, future)
+            raise
+        finally:
+            self.waited += 1
+            self.wait_seconds += time.monotonic() - started
+
+    def _grant(self, session_key: str, cls: _Class):
+        cls.active += 1
+        self._active[session_key] = self._active.get(session_key, 0) + 1
+
+    def _make_ready(self, session_key: str, cls: _Class):
+        queue = cls.queues.get(session_key)
+        if (queue and session_key not in cls.in_ready
+                and self._active.get(session_key, 0) < self._limit(session_key)):
+            heapq.heappush(cls.ready, (queue[0][0], next(self._order), session_key))
+            cls.in_ready.add(session_key)
+
+    def _withdraw(self, session_key: str, cls: _Class, future: asyncio.Future):
+        queue = cls.queues.get(session_key)
+        if queue is None:
+            return
+        for index, (_, waiting) in enumerate(queue):
+            if waiting is future:
+                del queue[index]
+                cls.queued -= 1
+                break
+        if not queue:
+            del cls.queues[session_key]
+        # A stale entry in ready is skipped by _dispatch
+        self._dispatch()
+
+    def _release(self, session_key: str, priority: Priority):
+        self._classes[priority].active -= 1
+        active = self._active[session_key] - 1
+        if active:
+            self._active[session_key] = active
+        else:
+            del self._active[session_key]
+            if not any(session_key in cls.queues for cls in self._classes.values()):
+                # Idle sessions start again at the current virtual time
+                for cls in self._classes.values():
+                    cls.last_finish.pop(session_key, None)
+        for cls in self._classes.values():
+            self._make_ready(session_key, cls)
+        self._dispatch()
+
+    def _dispatch(self):
+        # Interactive first: bulk only gets slots no ready interactive request can use
+        for priority in PRIORITIES:
+            cls = self._classes[priority]
+            while cls.ready and self._has_room(priority):
+                _, _, session_key = heapq.heappop(cls.ready)
+                cls.in_ready.discard(session_key)
+                queue = cls.queues.get(session_key)
+                if queue and queue[0][1].done():
+                    # Cancelled in the same tick a slot was released, before _withdraw ran
+                    while queue and queue[0][1].done():
+                        queue.popleft()
+                        cls.queued -= 1
+                    if not queue:
+                        del cls.queues[session_key]
+                    # Ranked again by the finish tag of its next request
+                    self._make_ready(session_key, cls)
+                    continue
+                if not queue:
+                    continue
+                if self._active.get(session_key, 0) >= self._limit(session_key):
+                    # Parked until one of its requests ends, see _release
+                    continue
+                finish, future = queue.popleft()
+                cls.queued -= 1
+                if not queue:
+                    del cls.queues[session_key]
+                cls.virtual_time = max(cls.virtual_time, finish)
+                self._grant(session_key, cls)
+                future.set_result(None)
+                self._make_ready(session_key, cls)
+
+    def queue_depths(self, limit: int = 10) -> list[dict]:
+        """Sessions with the most waiting requests"""
+        depths: dict[str, dict] = {}
+        for priority, cls in self._classes.items():
+            for session_key, queue in cls.queues.items():
+                depths.setdefault(session_key, {"session": session_key, "interactive": 0, "bulk": 0})[priority] = len(queue)
+        ranked = sorted(depths.values(), key=lambda row: row["interactive"] + row["bulk"], reverse=True)
+        for row in ranked[:limit]:
+            row["active"] = self._active.get(row["session"], 0)
+        return ranked[:limit]
+
+    def stats(self) -> dict:
+        return {
+            "concurrency": self.concurrency,
+            "bulk_limit": self.bulk_limit,
+            "active": {priority: cls.active for priority, cls in self._classes.items()},
+            "queued": {priority: cls.queued for priority, cls in self._classes.items()},
+            "sessions_active": len(self._active),
+            "waited": self.waited,
+            "wait_seconds": round(self.wait_seconds, 3),
+            "top_queues": self.queue_depths(),
+        }
+
+
+scheduler = FairScheduler(
+    SCHEDULER_CONCURRENCY,
+    SCHEDULER_SESSION_CONCURRENCY,
+    SCHEDULER_BULK_SHARE,
+    SCHEDULER_SESSION_LIMITS
+)
@@ -0,0 +1,188 @@
+import asyncio
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, TypeVar
+
+from fastapi import HTTPException
+
+from telegram_api_server_stateless_utils import ClientPool, get_client_from_session, session_fingerprint
+
+# Path to SQLite file remembering active sessions for warm restarts; disabled when not set.
+# It holds full session strings, so it has to be protected like the sessions themselves
+SESSION_REGISTRY_DB = os.getenv("SESSION_REGISTRY_DB")
+# Sessions reconnected on startup, busiest first
+WARM_RESTART_SESSIONS = int(os.getenv("WARM_RESTART_SESSIONS", "100"))
+# Most connects running at once while warming up
+WARM_RESTART_CONCURRENCY = int(os.getenv("WARM_RESTART_CONCURRENCY", "10"))
+# Sessions not used for longer are forgotten
+SESSION_REGISTRY_MAX_AGE = float(os.getenv("SESSION_REGISTRY_MAX_AGE", str(7 * 24 * 3600)))
+SESSION_REGISTRY_FLUSH_INTERVAL = float(os.getenv("SESSION_REGISTRY_FLUSH_INTERVAL", "60"))
+
+T = TypeVar("T")
+
+
+class SessionRegistry:
+    """Sessions recently served from the client pool, reconnected after a restart.
+
+    The pool is written to the registry periodically and on shutdown. On
+    startup the busiest sessions are connected again in the background, so
+    their first requests find a ready client; requests arriving meanwhile
+    share the connect that is already running. SQLite runs on a thread of
+    its own so flushes do not block the event loop.
+    """
+
+    def __init__(self, db_path: Optional[str], warm_sessions: int, warm_concurrency: int,
+                 max_age: float, flush_interval: float):
+        self.warm_sessions = warm_sessions
+        self.warm_concurrency = warm_concurrency
+        self.max_age = max_age
+        self.flush_interval = flush_interval
+        self._db: Optional[sqlite3.Connection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # Stored sessions, counted after every write
+        self._size = 0
+        if db_path:
+            # Only the owner may read the session strings
+            os.close(os.open(db_path, os.O_CREAT | os.O_RDWR, 0o600))
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "key TEXT PRIMARY KEY, session TEXT NOT NULL, last_used REAL NOT NULL, uses INTEGER NOT NULL)"
+            )
+            self._db.commit()
+            self._size = self._db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-registry")
+        # Pool lookups already written per session, so a flush adds only new ones
+        self._flushed_uses: dict[str, int] = {}
+        self._warming: Optional[asyncio.Task] = None
+        self._flusher: Optional[asyncio.Task] = None
+        self.warmed = 0
+        self.warm_failed = 0
+
+    async def _run(self, func: Callable[..., T], *args) -> T:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def flush(self, pool: ClientPool):
+        """Write the pooled sessions and forget those unused for longer than max_age"""
+        if self._db is None:
+            return
+        rows = []
+        flushed_uses = {}
+        for session_string, last_used, uses in pool.snapshot():
+            key = session_fingerprint(session_string)
+            previous = self._flushed_uses.get(key, 0)
+            # Fewer uses than last time: the client left the pool and came back
+            rows.append((key, session_string, last_used, uses - previous if uses >= previous else uses))
+            flushed_uses[key] = uses
+        self._size = await self._run(self._write, rows)
+        self._flushed_uses = flushed_uses
+
+    def _write(self, rows: list[tuple]) -> int:
+        with self._db:
+            self._db.executemany(
+                "INSERT INTO sessions VALUES (?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET "
+                "session = excluded.session, last_used = max(last_used, excluded.last_used), "
+                "uses = uses + excluded.uses",
+                rows,
+            )
+            self._db.execute("DELETE FROM sessions WHERE last_used < ?", (time.time() - self.max_age,))
+        return self._db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    async def forget(self, session_string: str):
+        if self._db is None:
+            return
+        self._size = await self._run(self._delete, session_fingerprint(session_string))
+
+    def _delete(self, key: str) -> int:
+        with self._db:
+            self._db.execute("DELETE FROM sessions WHERE key = ?", (key,))
+        return self._db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    async def hottest(self, limit: int, owns: Optional[Callable[[str], bool]] = None) -> list[str]:
+        """Session strings of the busiest sessions, only those ``owns`` accepts"""
+        if self._db is None or limit <= 0:
+            return []
+        result = []
+        for key, session_string in await self._run(self._select):
+            if owns is None or owns(key):
+                result.append(session_string)
+                if len(result) >= limit:
+                    break
+        return result
+
+    def _select(self) -> list[tuple[str, str]]:
+        return self._db.execute(
+            "SELECT key, session FROM sessions WHERE last_used >= ? ORDER BY uses DESC, last_used DESC",
+            (time.time() - self.max_age,)
+        ).fetchall()
+
+    async def warm(self, pool: ClientPool, owns: Optional[Callable[[str], bool]] = None):
+        """Connect the busiest sessions, at most warm_concurrency at once"""
+        semaphore = asyncio.Semaphore(self.warm_concurrency)
+
+        async def connect(session_string: str):
+            async with semaphore:
+                if session_string in pool:
+                    return
+                try:
+                    await get_client_from_session(session_string)
+                    self.warmed += 1
+                except HTTPException:
+                    # Revoked or unreachable; it ages out of the registry unless used again
+                    self.warm_failed += 1
+
+        hottest = await self.hottest(self.warm_sessions, owns)
+        await asyncio.gather(*(connect(session_string) for session_string in hottest))
+
+    async def _flush_forever(self, pool: ClientPool):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush(pool)
+            except sqlite3.Error:
+                # Written again on the next flush
+                pass
+
+    def start(self, pool: ClientPool, owns: Optional[Callable[[str], bool]] = None):
+        """Warm up the pool in the background and keep the registry current"""
+        if self._db is None:
+            return
+        loop = asyncio.get_running_loop()
+        self._warming = loop.create_task(self.warm(pool, owns))
+        self._flusher = loop.create_task(self._flush_forever(pool))
+
+    async def close(self, pool: ClientPool):
+        """Write the pool a last time; call before the pool is closed"""
+        for task in (self._warming, self._flusher):
+            if task is not None:
+                task.cancel()
+        await asyncio.gather(*(task for task in (self._warming, self._flusher) if task is not None),
+                             return_exceptions=True)
+        self._warming = self._flusher = None
+        if self._db is not None:
+            await self.flush(pool)
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            self._db.close()
+            self._db = None
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self._db is not None,
+            "size": self._size if self._db is not None else 0,
+            "warming": self._warming is not None and not self._warming.done(),
+            "warmed": self.warmed,
+            "warm_failed": self.warm_failed,
+        }
+
+
+session_registry = SessionRegistry(
+    SESSION_REGISTRY_DB,
+    WARM_RESTART_SESSIONS,
+    WARM_RESTART_CONCURRENCY,
+    SESSION_REGISTRY_MAX_AGE,
+    SESSION_REGISTRY_FLUSH_INTERVAL
+)
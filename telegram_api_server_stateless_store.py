@@ -0,0 +1,408 @@
+import asyncio
+import os
+import re
+import sqlite3
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Callable, Optional, TypeVar
+
+from telethon import TelegramClient, events, utils
+from telethon.tl.functions.updates import GetStateRequest
+
+from telegram_api_server_stateless_models import MessageInfo, build_message_info
+from telegram_api_server_stateless_scheduler import bulk_priority
+
+# Path to SQLite file of the local message store; disabled when not set
+MESSAGE_STORE_DB = os.getenv("MESSAGE_STORE_DB")
+# Seconds between checks for new messages of a chat served from the store
+MESSAGE_STORE_SYNC_INTERVAL = float(os.getenv("MESSAGE_STORE_SYNC_INTERVAL", "30"))
+# New messages fetched in one sync; if there are more, the stored history restarts from them
+MESSAGE_STORE_SYNC_LIMIT = int(os.getenv("MESSAGE_STORE_SYNC_LIMIT", "1000"))
+# Upper bound of messages loaded by background backfill of one chat
+MESSAGE_STORE_BACKFILL_LIMIT = int(os.getenv("MESSAGE_STORE_BACKFILL_LIMIT", "100000"))
+
+_BACKFILL_PAGE_SIZE = 100
+
+T = TypeVar("T")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    session_key TEXT NOT NULL,
+    chat_id INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    date REAL NOT NULL,
+    text TEXT,
+    data TEXT NOT NULL,
+    UNIQUE (session_key, chat_id, id)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    text, content='messages', content_rowid='rowid'
+);
+CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts(rowid, text) VALUES (new.rowid, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_au AFTER UPDATE ON messages BEGIN
+    INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+    INSERT INTO messages_fts(rowid, text) VALUES (new.rowid, new.text);
+END;
+CREATE TABLE IF NOT EXISTS chat_sync (
+    session_key TEXT NOT NULL,
+    chat_id INTEGER NOT NULL,
+    min_id INTEGER NOT NULL,
+    max_id INTEGER NOT NULL,
+    complete INTEGER NOT NULL,
+    synced_at REAL NOT NULL,
+    PRIMARY KEY (session_key, chat_id)
+);
+"""
+
+
+def as_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """Treat naive datetimes from query parameters as UTC"""
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+@dataclass
+class ChatSync:
+    """Stored range of chat history: every message with min_id <= id <= max_id is in the store"""
+    min_id: int
+    max_id: int
+    complete: bool
+    synced_at: float
+
+
+class MessageStore:
+    """Local copy of chat history with full-text search.
+
+    For every chat the store keeps one gapless range of message ids, so a
+    page inside that range can be answered without asking Telegram. The
+    range grows upwards on sync and downwards as older pages are fetched.
+
+    Edits and deletions are applied as Telegram pushes them to the pooled
+    client of the session (and from /messages/since). Staleness is bounded
+    as follows: new messages show up at most MESSAGE_STORE_SYNC_INTERVAL
+    seconds late, while edits and deletions made while the session had no
+    connected client stay unseen until the chat history is stored anew.
+
+    SQLite runs on a thread of its own, one statement batch at a time and
+    in call order, so large pages and searches do not block the event loop.
+    """
+
+    def __init__(self, db_path: Optional[str]):
+        self._db: Optional[sqlite3.Connection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._syncing: dict[tuple[str, int], asyncio.Task] = {}
+        self._backfills: dict[tuple[str, int], asyncio.Task] = {}
+        # Clients whose edit and deletion events are applied to the store
+        self._tracked: weakref.WeakSet[TelegramClient] = weakref.WeakSet()
+        self.hits = 0
+        self.misses = 0
+        self.events = 0
+        if db_path:
+            # Holds the text of private chats, only the owner may read it
+            os.close(os.open(db_path, os.O_CREAT | os.O_RDWR, 0o600))
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript(_SCHEMA)
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="message-store")
+
+    @property
+    def enabled(self) -> bool:
+        return self._db is not None
+
+    async def _run(self, func: Callable[..., T], *args) -> T:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def get_sync(self, session_key: str, chat_id: int) -> Optional[ChatSync]:
+        row = self._db.execute(
+            "SELECT min_id, max_id, complete, synced_at FROM chat_sync WHERE session_key = ? AND chat_id = ?",
+            (session_key, chat_id),
+        ).fetchone()
+        return ChatSync(row[0], row[1], bool(row[2]), row[3]) if row else None
+
+    def _set_sync(self, session_key: str, chat_id: int, sync: ChatSync):
+        self._db.execute(
+            "INSERT OR REPLACE INTO chat_sync VALUES (?, ?, ?, ?, ?, ?)",
+            (session_key, chat_id, sync.min_id, sync.max_id, int(sync.complete), sync.synced_at),
+        )
+
+    def _insert(self, session_key: str, chat_id: int, messages: list[MessageInfo]):
+        self._db.executemany(
+            "INSERT INTO messages (session_key, chat_id, id, date, text, data) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (session_key, chat_id, id) DO UPDATE SET "
+            "date = excluded.date, text = excluded.text, data = excluded.data",
+            [
+                (session_key, chat_id, info.id, info.date.timestamp(), info.text, info.model_dump_json())
+                for info in messages
+            ],
+        )
+
+    async def save_page(self, session_key: str, chat_id: int, messages: list[MessageInfo],
+                        offset_id: int, reached_start: bool) -> bool:
+        """Store a page of history (newest first) fetched with ``offset_id``.
+
+        The page is kept only if it touches the stored range, so the range
+        stays gapless. Returns whether the page was stored.
+        """
+        return await self._run(self._save_page, session_key, chat_id, messages, offset_id, reached_start)
+
+    def _save_page(self, session_key: str, chat_id: int, messages: list[MessageInfo],
+                   offset_id: int, reached_start: bool) -> bool:
+        sync = self.get_sync(session_key, chat_id)
+        # The page covers every id from its last message up to offset_id - 1
+        top = offset_id - 1 if offset_id else None
+        bottom = 0 if reached_start else (messages[-1].id if messages else None)
+        if bottom is None:
+            return False
+
+        if sync is None:
+            if top is not None:
+                return False
+            top_id = messages[0].id if messages else 0
+            sync = ChatSync(bottom, top_id, reached_start, time.time())
+        else:
+            covers_top = top is None or top >= sync.min_id - 1
+            covers_bottom = bottom <= sync.max_id + 1
+            if not (covers_top and covers_bottom):
+                return False
+            sync.min_id = min(sync.min_id, bottom)
+            if top is None and messages:
+                sync.max_id = max(sync.max_id, messages[0].id)
+                sync.synced_at = time.time()
+            sync.complete = sync.complete or reached_start
+
+        with self._db:
+            self._insert(session_key, chat_id, messages)
+            self._set_sync(session_key, chat_id, sync)
+        return True
+
+    def _restart(self, session_key: str, chat_id: int, messages: list[MessageInfo]):
+        with self._db:
+            self._db.execute("DELETE FROM messages WHERE session_key = ? AND chat_id = ?", (session_key, chat_id))
+            self._insert(session_key, chat_id, messages)
+            self._set_sync(session_key, chat_id, ChatSync(messages[-1].id, messages[0].id, False, time.time()))
+
+    def _extend(self, session_key: str, chat_id: int, messages: list[MessageInfo], sync: ChatSync):
+        with self._db:
+            self._insert(session_key, chat_id, messages)
+            self._set_sync(session_key, chat_id, sync)
+
+    async def apply_edit(self, session_key: str, chat_id: int, message: MessageInfo):
+        """Update stored copy of an edited message, if it is stored"""
+        await self._run(self._apply_edit, session_key, chat_id, message)
+
+    def _apply_edit(self, session_key: str, chat_id: int, message: MessageInfo):
+        with self._db:
+            self._db.execute(
+                "UPDATE messages SET text = ?, data = ? WHERE session_key = ? AND chat_id = ? AND id = ?",
+                (message.text, message.model_dump_json(), session_key, chat_id, message.id),
+            )
+
+    async def apply_deletion(self, session_key: str, chat_id: Optional[int], message_ids: list[int]):
+        """Remove deleted messages; without chat_id (private chats, groups) ids are unique per account"""
+        if message_ids:
+            await self._run(self._apply_deletion, session_key, chat_id, message_ids)
+
+    def _apply_deletion(self, session_key: str, chat_id: Optional[int], message_ids: list[int]):
+        placeholders = ", ".join("?" * len(message_ids))
+        with self._db:
+            if chat_id is None:
+                self._db.execute(
+                    f"DELETE FROM messages WHERE session_key = ? AND chat_id > ? AND id IN ({placeholders})",
+                    (session_key, -1000000000000, *message_ids),
+                )
+            else:
+                self._db.execute(
+                    f"DELETE FROM messages WHERE session_key = ? AND chat_id = ? AND id IN ({placeholders})",
+                    (session_key, chat_id, *message_ids),
+                )
+
+    def query(self, session_key: str, chat_id: int, limit: int, offset_id: int = 0,
+              search: Optional[str] = None, from_date: Optional[datetime] = None,
+              to_date: Optional[datetime] = None) -> Optional[list[str]]:
+        """Return page from the store as MessageInfo JSON, or None if the stored range can not answer it"""
+        sync = self.get_sync(session_key, chat_id)
+        if sync is None or (search and not sync.complete):
+            return None
+
+        where = ["m.session_key = ?", "m.chat_id = ?", "m.id >= ?"]
+        params: list = [session_key, chat_id, sync.min_id]
+        if offset_id:
+            where.append("m.id < ?")
+            params.append(offset_id)
+        if from_date:
+            where.append("m.date >= ?")
+            params.append(as_utc(from_date).timestamp())
+        if to_date:
+            where.append("m.date < ?")
+            params.append(as_utc(to_date).timestamp())
+
+        source = "messages m"
+        if search:
+            fts_query = _fts_query(search)
+            if fts_query is None:
+                return None
+            source = "messages_fts f JOIN messages m ON m.rowid = f.rowid"
+            where.append("messages_fts MATCH ?")
+            params.append(fts_query)
+
+        rows = self._db.execute(
+            f"SELECT m.data, m.date FROM {source} WHERE {' AND '.join(where)} ORDER BY m.id DESC LIMIT ?",
+            (*params, limit),
+        ).fetchall()
+
+        covered = len(rows) == limit or sync.complete
+        if not covered and from_date:
+            # Older stored messages exist beyond from_date, so nothing is missing
+            oldest = self._db.execute(
+                "SELECT date FROM messages WHERE session_key = ? AND chat_id = ? AND id = "
+                "(SELECT MIN(id) FROM messages WHERE session_key = ? AND chat_id = ?)",
+                (session_key, chat_id, session_key, chat_id),
+            ).fetchone()
+            covered = oldest is not None and oldest[0] < as_utc(from_date).timestamp()
+        if not covered:
+            return None
+        return [row[0] for row in rows]
+
+    async def track(self, client: TelegramClient):
+        """Apply the edits and deletions Telegram pushes to client from now on"""
+        if client in self._tracked:
+            return
+        self._tracked.add(client)
+        client.add_event_handler(self._on_edited, events.MessageEdited())
+        client.add_event_handler(self._on_deleted, events.MessageDeleted())
+        # Telegram starts pushing updates to a connection after its first request about update state
+        await client(GetStateRequest())
+
+    async def _on_edited(self, event):
+        self.events += 1
+        await self.apply_edit(event.client.session_key, event.chat_id, build_message_info(event.message))
+
+    async def _on_deleted(self, event):
+        self.events += 1
+        await self.apply_deletion(event.client.session_key, event.chat_id, list(event.deleted_ids))
+
+    async def sync(self, client: TelegramClient, chat_id: int, entity):
+        """Fetch messages newer than the stored range, at most once per sync interval"""
+        key = (client.session_key, chat_id)
+        sync = await self._run(self.get_sync, *key)
+        if sync is not None and time.time() - sync.synced_at < MESSAGE_STORE_SYNC_INTERVAL:
+            return
+        task = self._syncing.get(key)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(self._sync(client, chat_id, entity, sync))
+            self._syncing[key] = task
+            task.add_done_callback(lambda t: self._syncing.pop(key, None))
+        await asyncio.shield(task)
+
+    async def _sync(self, client: TelegramClient, chat_id: int, entity, sync: Optional[ChatSync]):
+        if sync is None:
+            messages = await client.get_messages(entity, limit=_BACKFILL_PAGE_SIZE, wait_time=0)
+            await self.save_page(client.session_key, chat_id, [build_message_info(msg) for msg in messages],
+                           0, len(messages) < _BACKFILL_PAGE_SIZE)
+            return
+
+        messages = await client.get_messages(
+            entity, limit=MESSAGE_STORE_SYNC_LIMIT, min_id=sync.max_id, wait_time=0
+        )
+        infos = [build_message_info(msg) for msg in messages]
+        if len(messages) >= MESSAGE_STORE_SYNC_LIMIT:
+            # Too many new messages to close the gap cheaply, start the range over
+            await self._run(self._restart, client.session_key, chat_id, infos)
+            return
+        sync.synced_at = time.time()
+        if infos:
+            sync.max_id = max(sync.max_id, infos[0].id)
+        await self._run(self._extend, client.session_key, chat_id, infos, sync)
+
+    def start_backfill(self, client: TelegramClient, chat_id: int, entity):
+        """Load older history of chat in the background, so searches can be served locally"""
+        key = (client.session_key, chat_id)
+        if key in self._backfills:
+            return
+        task = asyncio.get_running_loop().create_task(self._backfill(client, chat_id, entity))
+        self._backfills[key] = task
+        task.add_done_callback(lambda t: self._backfills.pop(key, None))
+
+    async def _backfill(self, client: TelegramClient, chat_id: int, entity):
+        with bulk_priority():
+            await self._backfill_pages(client, chat_id, entity)
+
+    async def _backfill_pages(self, client: TelegramClient, chat_id: int, entity):
+        loaded = 0
+        while loaded < MESSAGE_STORE_BACKFILL_LIMIT:
+            sync = await self._run(self.get_sync, client.session_key, chat_id)
+            if sync is None or sync.complete:
+                return
+            messages = await client.get_messages(
+                entity, limit=_BACKFILL_PAGE_SIZE, offset_id=sync.min_id, wait_time=0
+            )
+            infos = [build_message_info(msg) for msg in messages]
+            reached_start = len(messages) < _BACKFILL_PAGE_SIZE
+            if not await self.save_page(client.session_key, chat_id, infos, sync.min_id, reached_start):
+                return
+            loaded += len(messages)
+
+    async def read(self, client: TelegramClient, entity, limit: int, offset_id: int = 0,
+                   search: Optional[str] = None, from_date: Optional[datetime] = None,
+                   to_date: Optional[datetime] = None, raw: bool = False) -> Optional[list]:
+        """Serve /messages/ page from the store, syncing new messages first.
+
+        With ``raw=True`` messages are returned as stored JSON strings, e.g.
+        to compare them with a cached response before parsing.
+        """
+        chat_id = utils.get_peer_id(entity)
+        await self.track(client)
+        await self.sync(client, chat_id, entity)
+        messages = await self._run(
+            self.query, client.session_key, chat_id, limit, offset_id, search, from_date, to_date
+        )
+        if messages is None:
+            self.misses += 1
+            if search:
+                self.start_backfill(client, chat_id, entity)
+        else:
+            self.hits += 1
+            if not raw:
+                messages = [MessageInfo.model_validate_json(data) for data in messages]
+        return messages
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "events": self.events,
+            "backfills": len(self._backfills),
+        }
+
+    def close(self):
+        for task in self._backfills.values():
+            task.cancel()
+        if self._executor is not None:
+            # Let statements already queued finish before the connection goes away
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+def _fts_query(search: str) -> Optional[str]:
+    """Turn user text into FTS5 query matching messages that contain words starting with every term"""
+    terms = re.findall(r"\w+", search)
+    if not terms:
+        return None
+    return " ".join(f'"{term}"*' for term in terms)
+
+
+message_store = MessageStore(MESSAGE_STORE_DB)
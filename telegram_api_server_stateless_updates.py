@@ -0,0 +1,461 @@
+import asyncio
+import base64
+import json
+import os
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from fastapi import APIRouter, Header, HTTPException, Query, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+from telethon import TelegramClient, events
+from telethon.errors import FloodWaitError
+from telethon.tl import types
+from telethon.tl.functions.channels import GetFullChannelRequest
+from telethon.tl.functions.updates import GetChannelDifferenceRequest, GetDifferenceRequest, GetStateRequest
+from telethon.utils import get_peer_id
+
+from telegram_api_server_stateless_json import dumps, message_payload
+from telegram_api_server_stateless_models import (
+    ChangedMessage,
+    ChangesResponse,
+    DeletedMessages,
+    build_message_info
+)
+from telegram_api_server_stateless_peers import peer_cache, resolve_peer
+from telegram_api_server_stateless_store import message_store
+from telegram_api_server_stateless_utils import clients, get_client_from_session, session_from_subprotocols
+
+router = APIRouter(prefix="/updates", tags=["updates"])
+
+# Events buffered for one connection before the oldest ones are dropped
+UPDATES_QUEUE_SIZE = int(os.getenv("UPDATES_QUEUE_SIZE", "1000"))
+# Seconds between keep-alive comments on the SSE stream
+UPDATES_SSE_HEARTBEAT = float(os.getenv("UPDATES_SSE_HEARTBEAT", "15"))
+
+EVENT_TYPES = ("new", "edited", "deleted")
+
+# Subprotocol /updates accepts with when offered next to the session subprotocol
+UPDATES_SUBPROTOCOL = "telegram-updates"
+
+# Maximum number of changes returned by one /messages/since call
+CHANGES_LIMIT = int(os.getenv("CHANGES_LIMIT", "1000"))
+
+
+class Subscription:
+    """Bounded event queue of one connection.
+
+    An edit of a message that is still waiting in the queue replaces the
+    queued event. When the queue is full the oldest event is dropped and
+    the consumer gets a ``{"type": "dropped", "count": N}`` event first.
+    """
+
+    def __init__(self, chat_ids: Optional[set[int]], types: set[str], max_size: int = UPDATES_QUEUE_SIZE):
+        self.chat_ids = chat_ids
+        self.types = types
+        self.max_size = max_size
+        self._queue: OrderedDict[object, dict] = OrderedDict()
+        self._sequence = 0
+        self._ready = asyncio.Event()
+        self.dropped = 0
+        self.closed = False
+
+    def wants(self, event_type: str, chat_id: Optional[int]) -> bool:
+        if event_type not in self.types:
+            return False
+        # Telegram does not tell the chat of deletions outside channels
+        return self.chat_ids is None or chat_id is None or chat_id in self.chat_ids
+
+    def put(self, event: dict):
+        if event["type"] == "edited":
+            key = ("edited", event["chat_id"], event["message"]["id"])
+            if key in self._queue:
+                self._queue[key] = event
+                return
+        else:
+            self._sequence += 1
+            key = self._sequence
+
+        if len(self._queue) >= self.max_size:
+            self._queue.popitem(last=False)
+            self.dropped += 1
+        self._queue[key] = event
+        self._ready.set()
+
+    def close(self):
+        """End the subscription, get() returns None once the queue is drained"""
+        self.closed = True
+        self._ready.set()
+
+    async def get(self) -> Optional[dict]:
+        while not self._queue and not self.dropped:
+            if self.closed:
+                return None
+            self._ready.clear()
+            await self._ready.wait()
+        if self.dropped:
+            event = {"type": "dropped", "count": self.dropped}
+            self.dropped = 0
+            return event
+        return self._queue.popitem(last=False)[1]
+
+
+class UpdateHub:
+    """Telethon event handlers of one pooled client, fanned out to subscriptions"""
+
+    def __init__(self, session_string: str, client: TelegramClient):
+        self.session_string = session_string
+        self.client = client
+        self.subscriptions: set[Subscription] = set()
+        self.stopped = False
+        self.starting: Optional[asyncio.Future] = None
+        self._handlers = [
+            (self._on_new, events.NewMessage()),
+            (self._on_edited, events.MessageEdited()),
+            (self._on_deleted, events.MessageDeleted()),
+        ]
+
+    async def start(self):
+        clients.pin(self.session_string)
+        for callback, event in self._handlers:
+            self.client.add_event_handler(callback, event)
+        # Telegram starts pushing updates to a connection after its first request about update state
+        await self.client(GetStateRequest())
+
+    def stop(self):
+        if self.stopped:
+            return
+        self.stopped = True
+        for callback, _ in self._handlers:
+            self.client.remove_event_handler(callback)
+        clients.unpin(self.session_string)
+
+    def _publish(self, event_type: str, chat_id: Optional[int], payload: dict):
+        event = None
+        for subscription in self.subscriptions:
+            if subscription.wants(event_type, chat_id):
+                if event is None:
+                    event = {"type": event_type, "chat_id": chat_id, **payload}
+                subscription.put(event)
+
+    async def _on_new(self, event):
+        self._publish("new", event.chat_id, {"message": message_payload(event.message)})
+
+    async def _on_edited(self, event):
+        self._publish("edited", event.chat_id, {"message": message_payload(event.message)})
+
+    async def _on_deleted(self, event):
+        self._publish("deleted", event.chat_id, {"message_ids": list(event.deleted_ids)})
+
+
+_hubs: dict[str, UpdateHub] = {}
+
+
+async def subscribe(session_string: str, chat_ids: Optional[List[str]], types: Optional[List[str]]) -> tuple[UpdateHub, Subscription]:
+    client = await get_client_from_session(session_string)
+
+    types = set(types or EVENT_TYPES)
+    unknown = types - set(EVENT_TYPES)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown event types: {', '.join(sorted(unknown))}")
+
+    marked_ids = None
+    if chat_ids:
+        try:
+            marked_ids = {get_peer_id(await resolve_peer(client, chat_id)) for chat_id in chat_ids}
+        except ValueError as e:
+            raise HTTPException(status_code=404, detail=f"Chat not found: {str(e)}")
+
+    hub = _hubs.get(client.session_key)
+    if hub is not None and hub.client is not client:
+        # The pooled client was replaced: the old one no longer receives updates, so its
+        # connections are ended and reconnect to the new client
+        hub.stop()
+        for subscription in hub.subscriptions:
+            subscription.close()
+        hub = None
+    if hub is None:
+        hub = UpdateHub(session_string, client)
+        _hubs[client.session_key] = hub
+        hub.starting = asyncio.ensure_future(_start_hub(hub))
+    # Concurrent subscribers share one start; shielded so a cancelled one does not abort it
+    await asyncio.shield(hub.starting)
+
+    subscription = Subscription(marked_ids, types)
+    hub.subscriptions.add(subscription)
+    return hub, subscription
+
+
+async def _start_hub(hub: UpdateHub):
+    try:
+        await hub.start()
+    except BaseException:
+        # Not left registered half started, the next subscriber starts a new hub
+        hub.stop()
+        if _hubs.get(hub.client.session_key) is hub:
+            del _hubs[hub.client.session_key]
+        raise
+
+
+def unsubscribe(hub: UpdateHub, subscription: Subscription):
+    hub.subscriptions.discard(subscription)
+    if not hub.subscriptions and _hubs.get(hub.client.session_key) is hub:
+        del _hubs[hub.client.session_key]
+        hub.stop()
+
+
+@router.websocket("")
+async def updates_websocket(
+        websocket: WebSocket,
+        chat_id: Optional[List[str]] = Query(None),
+        types: Optional[List[str]] = Query(None),
+        session_string: Optional[str] = Header(None, alias="X-Session-String")
+):
+    """Push new, edited and deleted messages as JSON text frames.
+
+    Browsers can not set headers on WebSocket requests, so the session may
+    also be offered as the subprotocol ``session.<base64url session string>``
+    together with ``telegram-updates``, which the server accepts with.
+    """
+    subprotocol = None
+    if not session_string:
+        offered = session_from_subprotocols(websocket.scope.get("subprotocols", ()))
+        if offered is not None:
+            session_string = offered[1]
+    if UPDATES_SUBPROTOCOL in websocket.scope.get("subprotocols", ()):
+        subprotocol = UPDATES_SUBPROTOCOL
+    if not session_string:
+        await websocket.close(code=4401, reason="Session is required")
+        return
+    try:
+        hub, subscription = await subscribe(session_string, chat_id, types)
+    except HTTPException as e:
+        await websocket.close(code=4000 + e.status_code, reason=str(e.detail))
+        return
+    except FloodWaitError as e:
+        await websocket.close(code=4429, reason=f"Flood wait of {e.seconds} seconds")
+        return
+    except Exception:
+        # Close reasons are limited to 123 bytes, the error itself may not fit
+        await websocket.close(code=1011, reason="Could not subscribe to updates")
+        return
+
+    await websocket.accept(subprotocol=subprotocol)
+    try:
+        receiver = asyncio.ensure_future(websocket.receive())
+        getter = asyncio.ensure_future(subscription.get())
+        while True:
+            done, _ = await asyncio.wait({getter, receiver}, return_when=asyncio.FIRST_COMPLETED)
+            # An event already taken off the queue is sent even if a frame arrived with it
+            if getter in done:
+                event = getter.result()
+                if event is None:
+                    # Client replaced, the consumer should connect again
+                    await websocket.close(code=1012)
+                    break
+                await websocket.send_text(dumps(event).decode())
+                getter = asyncio.ensure_future(subscription.get())
+            if receiver in done:
+                if receiver.result()["type"] == "websocket.disconnect":
+                    break
+                receiver = asyncio.ensure_future(websocket.receive())
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receiver.cancel()
+        getter.cancel()
+        unsubscribe(hub, subscription)
+
+
+@router.get("/sse")
+async def updates_sse(
+        chat_id: Optional[List[str]] = Query(None),
+        types: Optional[List[str]] = Query(None),
+        session_string: str = Header(..., alias="X-Session-String")
+):
+    """Server-Sent Events version of /updates for clients without WebSocket"""
+    hub, subscription = await subscribe(session_string, chat_id, types)
+
+    async def stream():
+        while True:
+            try:
+                event = await asyncio.wait_for(subscription.get(), UPDATES_SSE_HEARTBEAT)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            if event is None:
+                return
+            yield f"event: {event['type']}\ndata: {dumps(event).decode()}\n\n"
+
+    return _SubscriptionResponse(
+        hub, subscription, stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"}
+    )
+
+
+class _SubscriptionResponse(StreamingResponse):
+    """Ends the subscription however the response ends, even if its body was never started"""
+
+    def __init__(self, hub: UpdateHub, subscription: Subscription, content, **kwargs):
+        super().__init__(content, **kwargs)
+        self.hub = hub
+        self.subscription = subscription
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            unsubscribe(self.hub, self.subscription)
+
+
+def _encode_token(data: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip("=")
+
+
+def _decode_token(token: str) -> dict:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        int(data["pts"])
+        return data
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid token")
+
+
+class _Changes:
+    """Collects messages and deletions from a difference, optionally for one chat"""
+
+    def __init__(self, client: TelegramClient, chat_id: Optional[int]):
+        self.client = client
+        self.chat_id = chat_id
+        self.entities = {}
+        self.new: List[ChangedMessage] = []
+        self.edited: List[ChangedMessage] = []
+        self.deleted: List[DeletedMessages] = []
+        self.changed_channels: List[int] = []
+
+    def add_entities(self, users, chats):
+        entities = [*users, *chats]
+        peer_cache.remember_entities(self.client.session_key, entities)
+        self.entities.update({get_peer_id(entity): entity for entity in entities})
+
+    def _message(self, message, target: List[ChangedMessage]):
+        # Service messages (joins, pins, ...) have no content to report
+        if not isinstance(message, types.Message):
+            return
+        chat_id = get_peer_id(message.peer_id)
+        if self.chat_id is not None and chat_id != self.chat_id:
+            return
+        message._finish_init(self.client, self.entities, None)
+        target.append(ChangedMessage(chat_id=chat_id, message=build_message_info(message)))
+
+    def _deleted(self, chat_id: Optional[int], message_ids: List[int]):
+        if self.chat_id is None or chat_id is None or chat_id == self.chat_id:
+            self.deleted.append(DeletedMessages(chat_id=chat_id, message_ids=message_ids))
+
+    def add(self, new_messages, other_updates):
+        for message in new_messages:
+            self._message(message, self.new)
+        for update in other_updates:
+            if isinstance(update, (types.UpdateNewMessage, types.UpdateNewChannelMessage)):
+                self._message(update.message, self.new)
+            elif isinstance(update, (types.UpdateEditMessage, types.UpdateEditChannelMessage)):
+                self._message(update.message, self.edited)
+            elif isinstance(update, types.UpdateDeleteMessages):
+                self._deleted(None, update.messages)
+            elif isinstance(update, types.UpdateDeleteChannelMessages):
+                self._deleted(get_peer_id(types.PeerChannel(update.channel_id)), update.messages)
+            elif isinstance(update, types.UpdateChannelTooLong) and self.chat_id is None:
+                self.changed_channels.append(get_peer_id(types.PeerChannel(update.channel_id)))
+
+    async def response(self, token: dict, has_more: bool, reset: bool = False) -> ChangesResponse:
+        if message_store.enabled:
+            # Keep locally stored history in line with Telegram
+            for changed in self.edited:
+                await message_store.apply_edit(self.client.session_key, changed.chat_id, changed.message)
+            for deleted in self.deleted:
+                await message_store.apply_deletion(self.client.session_key, deleted.chat_id, deleted.message_ids)
+        return ChangesResponse(
+            new_messages=self.new,
+            edited_messages=self.edited,
+            deleted_messages=self.deleted,
+            changed_channels=self.changed_channels,
+            token=_encode_token(token),
+            has_more=has_more,
+            reset=reset
+        )
+
+
+async def _common_changes(client: TelegramClient, token: Optional[str], chat_id: Optional[int]) -> ChangesResponse:
+    changes = _Changes(client, chat_id)
+    if token is None:
+        state = await client(GetStateRequest())
+        return await changes.response({"pts": state.pts, "qts": state.qts, "date": int(state.date.timestamp())}, False)
+
+    data = _decode_token(token)
+    if "channel" in data:
+        raise HTTPException(status_code=400, detail="Token belongs to a channel, pass its chat_id")
+
+    difference = await client(GetDifferenceRequest(
+        pts=data["pts"],
+        date=datetime.fromtimestamp(data["date"], tz=timezone.utc),
+        qts=data["qts"],
+        pts_total_limit=CHANGES_LIMIT
+    ))
+    if isinstance(difference, types.updates.DifferenceEmpty):
+        return await changes.response({**data, "date": int(difference.date.timestamp())}, False)
+    if isinstance(difference, types.updates.DifferenceTooLong):
+        return await changes.response({**data, "pts": difference.pts}, False, reset=True)
+
+    is_slice = isinstance(difference, types.updates.DifferenceSlice)
+    state = difference.intermediate_state if is_slice else difference.state
+    changes.add_entities(difference.users, difference.chats)
+    changes.add(difference.new_messages, difference.other_updates)
+    return await changes.response(
+        {"pts": state.pts, "qts": state.qts, "date": int(state.date.timestamp())}, is_slice
+    )
+
+
+async def _channel_changes(client: TelegramClient, channel: types.InputPeerChannel,
+                           token: Optional[str]) -> ChangesResponse:
+    changes = _Changes(client, get_peer_id(channel))
+    if token is None:
+        full = await client(GetFullChannelRequest(channel))
+        return await changes.response({"channel": channel.channel_id, "pts": full.full_chat.pts}, False)
+
+    data = _decode_token(token)
+    if data.get("channel") != channel.channel_id:
+        raise HTTPException(status_code=400, detail="Token belongs to another chat")
+
+    difference = await client(GetChannelDifferenceRequest(
+        channel=channel,
+        filter=types.ChannelMessagesFilterEmpty(),
+        pts=data["pts"],
+        limit=CHANGES_LIMIT,
+        force=True
+    ))
+    if isinstance(difference, types.updates.ChannelDifferenceEmpty):
+        return await changes.response({**data, "pts": difference.pts}, not difference.final)
+    if isinstance(difference, types.updates.ChannelDifferenceTooLong):
+        return await changes.response({**data, "pts": difference.dialog.pts}, False, reset=True)
+
+    changes.add_entities(difference.users, difference.chats)
+    changes.add(difference.new_messages, difference.other_updates)
+    return await changes.response({**data, "pts": difference.pts}, not difference.final)
+
+
+async def get_changes(client: TelegramClient, token: Optional[str], chat_id: Optional[str]) -> ChangesResponse:
+    """Return changes since token (or just the current token when it is not given).
+
+    Uses Telegram's getDifference, so the cost depends on the number of
+    changes and not on history size. Channels keep their own update state,
+    so for them a chat_id is required and their token is separate.
+    """
+    if chat_id is None:
+        return await _common_changes(client, token, None)
+
+    try:
+        entity = await resolve_peer(client, chat_id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=f"Chat not found: {str(e)}")
+    if isinstance(entity, types.InputPeerChannel):
+        return await _channel_changes(client, entity, token)
+    return await _common_changes(client, token, get_peer_id(entity))
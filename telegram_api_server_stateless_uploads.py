@@ -0,0 +1,348 @@
+import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Optional, Union
+
+from fastapi import HTTPException, Request
+from telethon import TelegramClient, helpers, utils
+from telethon.tl.functions.upload import SaveBigFilePartRequest, SaveFilePartRequest
+from telethon.tl.types import InputFile, InputFileBig, TypeInputMedia, TypeMessageMedia
+
+try:
+    import python_multipart as multipart
+    from python_multipart.multipart import parse_options_header
+except ModuleNotFoundError:  # python-multipart < 0.0.13
+    import multipart
+    from multipart.multipart import parse_options_header
+
+# Telegram accepts upload parts of up to 512 KB
+UPLOAD_PART_SIZE = 512 * 1024
+# Files up to this size are uploaded as "small" files (required for photos)
+SMALL_FILE_LIMIT = 10 * 1024 * 1024
+# Room for part headers, boundaries and the text fields of a form next to its file
+MULTIPART_OVERHEAD = 64 * 1024
+# Upload parts sent to Telegram at the same time for one file
+UPLOAD_PART_CONCURRENCY = int(os.getenv("UPLOAD_PART_CONCURRENCY", "4"))
+# Cache of already uploaded files (content hash -> Telegram media)
+UPLOAD_CACHE_MAX_SIZE = int(os.getenv("UPLOAD_CACHE_MAX_SIZE", "10000"))
+UPLOAD_CACHE_TTL = float(os.getenv("UPLOAD_CACHE_TTL", str(6 * 3600)))
+
+
+class StreamingUploader:
+    """Uploads a file to Telegram part by part while it is being received.
+
+    At most ``concurrency`` parts are in flight, so memory use does not
+    depend on the file size. Big files use Telegram's streamed upload mode:
+    every part except the last one is sent with ``file_total_parts=-1``.
+    With ``big=None`` the size is not known up front: data is held until it
+    passes SMALL_FILE_LIMIT or ends, whichever decides the mode.
+    """
+
+    def __init__(self, client: TelegramClient, file_name: str, big: Optional[bool] = None,
+                 concurrency: int = UPLOAD_PART_CONCURRENCY):
+        self.client = client
+        self.file_name = file_name
+        self.big = big
+        self.file_id = helpers.generate_random_long()
+        self.size = 0
+        self._buffer = bytearray()
+        self._held: Optional[bytes] = None
+        self._parts = 0
+        self._slots = asyncio.Semaphore(concurrency)
+        self._tasks: set[asyncio.Task] = set()
+        self._error: Optional[BaseException] = None
+
+    async def write(self, data: bytes):
+        self.size += len(data)
+        if self.size > SMALL_FILE_LIMIT:
+            if self.big is False:
+                raise HTTPException(status_code=400, detail="File is larger than announced in Content-Length")
+            self.big = True
+        self._buffer += data
+        if self.big is None:
+            return
+        while len(self._buffer) >= UPLOAD_PART_SIZE:
+            part = bytes(self._buffer[:UPLOAD_PART_SIZE])
+            del self._buffer[:UPLOAD_PART_SIZE]
+            await self._push(part)
+
+    async def _push(self, part: bytes):
+        if not self.big:
+            await self._send(part, None)
+            return
+        # The last part must carry the total count, so always hold one part back
+        if self._held is not None:
+            await self._send(self._held, -1)
+        self._held = part
+
+    async def _send(self, data: bytes, total_parts: Optional[int]):
+        await self._slots.acquire()
+        if self._error is not None:
+            self._slots.release()
+            raise self._error
+        index = self._parts
+        self._parts += 1
+        task = asyncio.get_running_loop().create_task(self._upload_part(index, data, total_parts))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _upload_part(self, index: int, data: bytes, total_parts: Optional[int]):
+        try:
+            if self.big:
+                request = SaveBigFilePartRequest(self.file_id, index, total_parts, data)
+            else:
+                request = SaveFilePartRequest(self.file_id, index, data)
+            if not await self.client(request):
+                raise RuntimeError(f"Failed to upload file part {index}")
+        except BaseException as e:
+            if self._error is None:
+                self._error = e
+        finally:
+            self._slots.release()
+
+    async def finish(self) -> Union[InputFile, InputFileBig]:
+        """Upload remaining data and return handle to use in send_file"""
+        if self.big is None:
+            # Ended within the limit: everything is still buffered, send it as a small file
+            self.big = False
+            while len(self._buffer) > UPLOAD_PART_SIZE:
+                part = bytes(self._buffer[:UPLOAD_PART_SIZE])
+                del self._buffer[:UPLOAD_PART_SIZE]
+                await self._push(part)
+        tail = bytes(self._buffer)
+        self._buffer.clear()
+        if self.big:
+            if self._held is not None and tail:
+                await self._send(self._held, -1)
+                self._held = tail
+            elif self._held is None:
+                self._held = tail
+            await self._send(self._held, self._parts + 1)
+            self._held = None
+        elif tail or self._parts == 0:
+            await self._send(tail, None)
+
+        if self._tasks:
+            await asyncio.gather(*self._tasks)
+        if self._error is not None:
+            raise self._error
+
+        if self.big:
+            return InputFileBig(self.file_id, self._parts, self.file_name)
+        return InputFile(self.file_id, self._parts, self.file_name, '')
+
+    async def abort(self):
+        for task in self._tasks:
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+@dataclass
+class UploadedForm:
+    fields: dict[str, str] = field(default_factory=dict)
+    file: Optional[Union[InputFile, InputFileBig]] = None
+    file_name: Optional[str] = None
+    file_size: int = 0
+    sha256: Optional[str] = None
+    big: bool = False
+
+
+async def _iter_multipart(request: Request) -> AsyncIterator[tuple[str, object]]:
+    """Parse multipart body incrementally, yielding ("part", headers), ("data", bytes) and ("end", None)"""
+    _, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if not boundary:
+        raise HTTPException(status_code=400, detail="Missing multipart boundary")
+
+    events: list[tuple[str, object]] = []
+    headers: dict[bytes, bytes] = {}
+    header_field = bytearray()
+    header_value = bytearray()
+
+    def on_part_begin():
+        headers.clear()
+
+    def on_header_field(data: bytes, start: int, end: int):
+        header_field.extend(data[start:end])
+
+    def on_header_value(data: bytes, start: int, end: int):
+        header_value.extend(data[start:end])
+
+    def on_header_end():
+        headers[bytes(header_field).lower()] = bytes(header_value)
+        header_field.clear()
+        header_value.clear()
+
+    def on_headers_finished():
+        events.append(("part", dict(headers)))
+
+    def on_part_data(data: bytes, start: int, end: int):
+        events.append(("data", data[start:end]))
+
+    def on_part_end():
+        events.append(("end", None))
+
+    parser = multipart.MultipartParser(boundary, {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+
+    async for chunk in request.stream():
+        parser.write(chunk)
+        for event in events:
+            yield event
+        events.clear()
+    parser.finalize()
+    for event in events:
+        yield event
+
+
+async def receive_upload(request: Request, client: TelegramClient, upload: bool = True) -> UploadedForm:
+    """Read multipart form, uploading its single file part to Telegram on the fly.
+
+    The SHA-256 of the file is always computed; with ``upload=False`` the
+    file is only hashed, e.g. when it is already known to the upload cache.
+    """
+    content_length = request.headers.get("content-length")
+    big = None
+    if content_length is not None:
+        try:
+            content_length = int(content_length)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid Content-Length")
+        # A body within the limit can only carry a small file, one well above it only a big file.
+        # Chunked bodies and the narrow band in between are decided by the bytes actually read
+        if content_length <= SMALL_FILE_LIMIT:
+            big = False
+        elif content_length > SMALL_FILE_LIMIT + MULTIPART_OVERHEAD:
+            big = True
+
+    form = UploadedForm()
+    uploader: Optional[StreamingUploader] = None
+    digest = None
+    field_name = None
+    field_value = bytearray()
+    try:
+        async for kind, payload in _iter_multipart(request):
+            if kind == "part":
+                _, options = parse_options_header(payload.get(b"content-disposition", b""))
+                field_name = options.get(b"name", b"").decode("utf-8")
+                file_name = options.get(b"filename")
+                if file_name is not None:
+                    if digest is not None:
+                        raise HTTPException(status_code=400, detail="Only one file can be sent")
+                    form.file_name = os.path.basename(file_name.decode("utf-8")) or "file"
+                    digest = hashlib.sha256()
+                    if upload:
+                        uploader = StreamingUploader(client, form.file_name, big)
+                    field_name = None
+            elif kind == "data":
+                if field_name is None:
+                    digest.update(payload)
+                    form.file_size += len(payload)
+                    if uploader is not None:
+                        await uploader.write(payload)
+                else:
+                    field_value.extend(payload)
+            elif kind == "end":
+                if field_name is not None:
+                    form.fields[field_name] = field_value.decode("utf-8")
+                field_value.clear()
+                field_name = None
+
+        if digest is not None:
+            form.sha256 = digest.hexdigest()
+        form.big = form.file_size > SMALL_FILE_LIMIT
+        if uploader is not None:
+            form.file = await uploader.finish()
+            form.big = uploader.big
+        return form
+    except BaseException:
+        if uploader is not None:
+            await uploader.abort()
+        raise
+
+
+class UploadCache:
+    """Per-session cache of file content hash to the media Telegram created for it.
+
+    Lets the same file be sent again without uploading its bytes. Entries
+    expire after ``ttl`` seconds since file references become stale.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[tuple[str, str], tuple[TypeInputMedia, float]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    def get(self, session_key: str, sha256: str) -> Optional[TypeInputMedia]:
+        key = (session_key, sha256.lower())
+        entry = self._entries.get(key)
+        if entry is None or entry[1] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, session_key: str, sha256: str, media: TypeMessageMedia):
+        try:
+            input_media = utils.get_input_media(media)
+        except TypeError:
+            return
+        key = (session_key, sha256.lower())
+        self._entries[key] = (input_media, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def discard(self, session_key: str, sha256: str):
+        self._entries.pop((session_key, sha256.lower()), None)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "bytes_saved": self.bytes_saved,
+        }
+
+
+upload_cache = UploadCache(UPLOAD_CACHE_MAX_SIZE, UPLOAD_CACHE_TTL)
+
+
+# Request body description for OpenAPI, since the form is parsed manually
+SEND_WITH_FILE_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["chat_id", "file"],
+                    "properties": {
+                        "chat_id": {"type": "string"},
+                        "text": {"type": "string"},
+                        "reply_to_message_id": {"type": "integer"},
+                        "file": {"type": "string", "format": "binary"},
+                    },
+                }
+            }
+        },
+    }
+}
@@ -1,24 +1,439 @@
+import asyncio
 import base64
+import hashlib
+import os
+import random
 import struct
-from typing import Optional
+import time
+from collections import OrderedDict
+from typing import AsyncGenerator, Optional, TypeVar
 from fastapi import HTTPException
 from telethon import TelegramClient
 from telethon.sessions import StringSession
+from telethon.tl.functions import PingRequest
+from telethon.tl.functions.upload import GetFileRequest, SaveBigFilePartRequest, SaveFilePartRequest
 
-# Dictionary to store active clients
-clients = {}
+from telegram_api_server_stateless_ratelimit import rate_limiter
+from telegram_api_server_stateless_scheduler import scheduler
+
+T = TypeVar("T")
+
+# Client pool limits (override through environment variables)
+CLIENT_POOL_MAX_SIZE = int(os.getenv("CLIENT_POOL_MAX_SIZE", "1000"))
+CLIENT_POOL_IDLE_TIMEOUT = float(os.getenv("CLIENT_POOL_IDLE_TIMEOUT", "900"))
+CLIENT_POOL_REAP_INTERVAL = float(os.getenv("CLIENT_POOL_REAP_INTERVAL", "60"))
+# Seconds shutdown waits for clients to disconnect
+CLIENT_POOL_CLOSE_TIMEOUT = float(os.getenv("CLIENT_POOL_CLOSE_TIMEOUT", "10"))
+# Clients idle this many seconds are pinged and reconnected when dead; 0 disables the checks
+CLIENT_POOL_PING_INTERVAL = float(os.getenv("CLIENT_POOL_PING_INTERVAL", "60"))
+CLIENT_POOL_PING_TIMEOUT = float(os.getenv("CLIENT_POOL_PING_TIMEOUT", "10"))
+# Most pings and reconnects running at once
+CLIENT_POOL_PING_CONCURRENCY = int(os.getenv("CLIENT_POOL_PING_CONCURRENCY", "20"))
+
+
+# File part transfers are not counted against the request rate, only flood waits apply
+_FILE_TRANSFER_REQUESTS = (GetFileRequest, SaveFilePartRequest, SaveBigFilePartRequest)
+
+
+class PooledTelegramClient(TelegramClient):
+    """TelegramClient whose every request goes through the shared rate limiter and fair scheduler"""
+
+    def __init__(self, session_key: str, *args, **kwargs):
+        # Flood waits are handled by the rate limiter instead of sleeping inside Telethon
+        kwargs.setdefault('flood_sleep_threshold', 0)
+        super().__init__(*args, **kwargs)
+        self.session_key = session_key
+
+    async def _call(self, sender, request, ordered=False, flood_sleep_threshold=None):
+        return await rate_limiter.run(
+            self.session_key,
+            self.api_id,
+            # Throttled requests wait for tokens before they take a scheduler slot
+            lambda: scheduler.run(self.session_key, lambda: super(PooledTelegramClient, self)._call(
+                sender, request, ordered=ordered, flood_sleep_threshold=flood_sleep_threshold
+            )),
+            limited=not isinstance(request, _FILE_TRANSFER_REQUESTS)
+        )
+
+    async def ping(self, timeout: float) -> bool:
+        """Whether the connection answers within timeout; not held back by the rate limiter"""
+        if not self.is_connected():
+            return False
+        request = PingRequest(ping_id=random.getrandbits(63))
+        try:
+            await asyncio.wait_for(TelegramClient._call(self, self._sender, request), timeout)
+            return True
+        except Exception:
+            return False
+
+
+class ClientPool:
+    """Bounded LRU pool of connected clients keyed by session string.
+
+    Supports the dict operations used by the auth endpoints (``in``, ``[]``,
+    ``del``, ``values()``). Clients pushed out by the size limit or left idle
+    longer than ``idle_timeout`` are disconnected in the background.
+    Clients idle for ``ping_interval`` are pinged, and reconnected when the
+    connection is dead, before a request has to find out. A pinned client
+    whose reconnect fails stays in the pool, marked dead, so its update
+    streams resume once a later reconnect succeeds.
+    """
+
+    def __init__(self, max_size: int, idle_timeout: float, reap_interval: float,
+                 close_timeout: float = CLIENT_POOL_CLOSE_TIMEOUT,
+                 ping_interval: float = CLIENT_POOL_PING_INTERVAL,
+                 ping_timeout: float = CLIENT_POOL_PING_TIMEOUT,
+                 ping_concurrency: int = CLIENT_POOL_PING_CONCURRENCY):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.reap_interval = reap_interval
+        self.close_timeout = close_timeout
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.ping_concurrency = ping_concurrency
+        self._clients: OrderedDict[str, TelegramClient] = OrderedDict()
+        self._last_used: dict[str, float] = {}
+        # Lookups per session since it joined the pool
+        self._uses: dict[str, int] = {}
+        self._connected_at: dict[str, float] = {}
+        self._reconnects: dict[str, int] = {}
+        self._reconnecting: dict[str, asyncio.Task] = {}
+        # Pinned sessions whose last reconnect failed, retried by requests and the health monitor
+        self._dead: set[str] = set()
+        self._closing: set[asyncio.Task] = set()
+        self._pinned: dict[str, int] = {}
+        self._reaper: Optional[asyncio.Task] = None
+        self._monitor: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.coalesced = 0
+        self.pings = 0
+        self.ping_failures = 0
+        self.reconnects = 0
+        self.reconnect_failures = 0
+
+    def __contains__(self, session_string: str) -> bool:
+        return session_string in self._clients
+
+    def __getitem__(self, session_string: str) -> TelegramClient:
+        client = self._clients[session_string]
+        self._touch(session_string)
+        return client
+
+    def __setitem__(self, session_string: str, client: TelegramClient):
+        if self._clients.get(session_string) is not client:
+            self._connected_at[session_string] = time.monotonic()
+            self._dead.discard(session_string)
+        self._clients[session_string] = client
+        self._touch(session_string)
+        overflow = len(self._clients) - self.max_size
+        if overflow > 0:
+            victims = [key for key in self._clients if key not in self._pinned][:overflow]
+            for old_session in victims:
+                old_client = self._clients.pop(old_session)
+                self._forget(old_session)
+                self.evictions += 1
+                self._disconnect_later(old_client)
+
+    def __delitem__(self, session_string: str):
+        del self._clients[session_string]
+        self._forget(session_string)
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+    def values(self):
+        return list(self._clients.values())
+
+    def lookup(self, session_string: str) -> Optional[TelegramClient]:
+        """Return pooled client (counting hit/miss) or None"""
+        client = self._clients.get(session_string)
+        if client is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._uses[session_string] = self._uses.get(session_string, 0) + 1
+        self._touch(session_string)
+        return client
+
+    def snapshot(self) -> list[tuple[str, float, int]]:
+        """Pooled sessions with the wall-clock time they were last used and their lookup count"""
+        offset = time.time() - time.monotonic()
+        return [
+            (session_string, self._last_used.get(session_string, 0) + offset, self._uses.get(session_string, 0))
+            for session_string in self._clients
+        ]
+
+    def pin(self, session_string: str):
+        """Keep client in the pool (e.g. while it streams updates) until unpinned"""
+        self._pinned[session_string] = self._pinned.get(session_string, 0) + 1
+
+    def unpin(self, session_string: str):
+        count = self._pinned.get(session_string, 0) - 1
+        if count > 0:
+            self._pinned[session_string] = count
+        else:
+            self._pinned.pop(session_string, None)
+            if session_string in self._dead:
+                # Kept only for its streams; the next request connects from scratch
+                self._disconnect_later(self._clients.pop(session_string))
+                self._forget(session_string)
+            elif session_string in self._clients:
+                self._touch(session_string)
+
+    def _touch(self, session_string: str):
+        self._clients.move_to_end(session_string)
+        self._last_used[session_string] = time.monotonic()
+
+    def _forget(self, session_string: str):
+        self._last_used.pop(session_string, None)
+        self._uses.pop(session_string, None)
+        self._connected_at.pop(session_string, None)
+        self._reconnects.pop(session_string, None)
+        self._dead.discard(session_string)
+
+    def _disconnect_later(self, client: TelegramClient):
+        try:
+            task = asyncio.get_running_loop().create_task(safe_disconnect(client))
+        except RuntimeError:
+            return
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    def reap_idle(self) -> int:
+        """Disconnect clients that were not used within idle_timeout"""
+        deadline = time.monotonic() - self.idle_timeout
+        expired = []
+        # OrderedDict is kept in LRU order, so stop at the first fresh entry
+        for session_string in self._clients:
+            if self._last_used.get(session_string, 0) > deadline:
+                break
+            if session_string not in self._pinned:
+                expired.append(session_string)
+
+        for session_string in expired:
+            client = self._clients.pop(session_string)
+            self._forget(session_string)
+            self.expirations += 1
+            self._disconnect_later(client)
+        return len(expired)
+
+    async def check_health(self):
+        """Ping clients idle for ping_interval and reconnect those that do not answer.
+
+        Clients used more recently just proved their connection works.
+        """
+        deadline = time.monotonic() - self.ping_interval
+        idle = [
+            (session_string, client) for session_string, client in self._clients.items()
+            if self._last_used.get(session_string, 0) <= deadline and session_string not in self._reconnecting
+        ]
+        semaphore = asyncio.Semaphore(self.ping_concurrency)
+
+        async def check(session_string: str, client: TelegramClient):
+            async with semaphore:
+                self.pings += 1
+                if await client.ping(self.ping_timeout):
+                    return
+                self.ping_failures += 1
+                if self._clients.get(session_string) is client:
+                    await self._start_reconnect(session_string, client)
+
+        await asyncio.gather(*(check(session_string, client) for session_string, client in idle))
+
+    def _start_reconnect(self, session_string: str, client: TelegramClient) -> asyncio.Task:
+        task = asyncio.get_running_loop().create_task(self._reconnect(session_string, client))
+        self._reconnecting[session_string] = task
+        task.add_done_callback(lambda t: self._reconnecting.pop(session_string, None))
+        return task
+
+    async def _reconnect(self, session_string: str, client: TelegramClient) -> bool:
+        try:
+            await client.disconnect()
+            await client.connect()
+        except Exception:
+            self.reconnect_failures += 1
+            if self._clients.get(session_string) is client and session_string in self._pinned:
+                # Update hubs hold this client: keep it and retry rather than strand them
+                self._dead.add(session_string)
+                return False
+            # The next request connects this session from scratch
+            if self._clients.get(session_string) is client:
+                del self[session_string]
+            await safe_disconnect(client)
+            return False
+        self.reconnects += 1
+        if self._clients.get(session_string) is not client:
+            # Left the pool meanwhile
+            await safe_disconnect(client)
+            return False
+        self._dead.discard(session_string)
+        self._connected_at[session_string] = time.monotonic()
+        self._reconnects[session_string] = self._reconnects.get(session_string, 0) + 1
+        return True
+
+    async def wait_reconnected(self, session_string: str) -> bool:
+        """Wait until a running reconnect of the session ends; False when it failed.
+
+        A dead pinned client is reconnected first; while that keeps failing
+        requests get a 503 instead of a second client next to the pinned one.
+        """
+        task = self._reconnecting.get(session_string)
+        if task is None and session_string in self._dead:
+            task = self._start_reconnect(session_string, self._clients[session_string])
+        if task is None:
+            return True
+        # Shield so a cancelled request does not abort the reconnect
+        if await asyncio.shield(task):
+            return True
+        if session_string in self._dead:
+            raise HTTPException(status_code=503, detail="Connection to Telegram lost, try again later")
+        return False
+
+    async def _monitor_forever(self):
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            await self.check_health()
+
+    def start_health_monitor(self):
+        if self.ping_interval > 0 and (self._monitor is None or self._monitor.done()):
+            self._monitor = asyncio.get_running_loop().create_task(self._monitor_forever())
+
+    def health(self) -> list[dict]:
+        """Connection state of every pooled client, identified by session fingerprint"""
+        now = time.monotonic()
+        return [
+            {
+                "session": session_fingerprint(session_string),
+                "connected": client.is_connected(),
+                "reconnecting": session_string in self._reconnecting,
+                "dead": session_string in self._dead,
+                "connection_age": round(now - self._connected_at.get(session_string, now), 1),
+                "idle": round(now - self._last_used.get(session_string, now), 1),
+                "reconnects": self._reconnects.get(session_string, 0),
+            }
+            for session_string, client in self._clients.items()
+        ]
+
+    async def _reap_forever(self):
+        while True:
+            await asyncio.sleep(self.reap_interval)
+            self.reap_idle()
+
+    def start_reaper(self):
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.get_running_loop().create_task(self._reap_forever())
+
+    async def close(self):
+        """Stop the reaper and disconnect every pooled client.
+
+        Clients disconnect in parallel; whatever is still open after
+        ``close_timeout`` is left to the process exit.
+        """
+        reconnecting = list(self._reconnecting.values())
+        for task in (self._reaper, self._monitor, *reconnecting):
+            if task is not None:
+                task.cancel()
+        self._reaper = self._monitor = None
+        clients_to_close = list(self._clients.values())
+        self._clients.clear()
+        self._last_used.clear()
+        self._uses.clear()
+        self._connected_at.clear()
+        self._reconnects.clear()
+        self._dead.clear()
+        tasks = [asyncio.ensure_future(safe_disconnect(client)) for client in clients_to_close]
+        tasks.extend(self._closing)
+        tasks.extend(reconnecting)
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=self.close_timeout)
+            for task in pending:
+                task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._clients),
+            "max_size": self.max_size,
+            "pinned": len(self._pinned),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "coalesced": self.coalesced,
+            "connecting": len(_connecting),
+            "pings": self.pings,
+            "ping_failures": self.ping_failures,
+            "reconnects": self.reconnects,
+            "reconnect_failures": self.reconnect_failures,
+            "reconnecting": len(self._reconnecting),
+            "dead": len(self._dead),
+        }
+
+
+async def safe_disconnect(client: TelegramClient):
+    """Disconnect client, ignoring errors of an already broken connection"""
+    try:
+        await client.disconnect()
+    except Exception:
+        pass
+
+
+# Pool of active clients
+clients = ClientPool(CLIENT_POOL_MAX_SIZE, CLIENT_POOL_IDLE_TIMEOUT, CLIENT_POOL_REAP_INTERVAL)
+
+# In-flight connects, so concurrent misses for one session share a single handshake
+_connecting: dict[str, asyncio.Task] = {}
 
 async def get_client_from_session(session_string: str) -> TelegramClient:
     """Create or get client from session string with credentials"""
-    if session_string in clients:
-        return clients[session_string]
+    client = clients.lookup(session_string)
+    # A client being reconnected by the health monitor is used once it is back
+    if client is not None and await clients.wait_reconnected(session_string):
+        return client
+
+    task = _connecting.get(session_string)
+    if task is not None:
+        clients.coalesced += 1
+    else:
+        task = asyncio.get_running_loop().create_task(_connect_client(session_string))
+        _connecting[session_string] = task
+        task.add_done_callback(lambda t: _connect_done(session_string, t))
+
+    # Shield so a cancelled request does not abort the connect other requests wait for
+    return await asyncio.shield(task)
+
 
+async def pinned_stream(session_string: str, chunks: AsyncGenerator[T, None]) -> AsyncGenerator[T, None]:
+    """Yield from chunks keeping the session's client in the pool until the stream ends"""
+    clients.pin(session_string)
+    try:
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        clients.unpin(session_string)
+        await chunks.aclose()
+
+
+def _connect_done(session_string: str, task: asyncio.Task):
+    if _connecting.get(session_string) is task:
+        del _connecting[session_string]
+    if not task.cancelled():
+        # Mark exception as retrieved in case every waiter went away
+        task.exception()
+
+
+async def _connect_client(session_string: str) -> TelegramClient:
+    client = None
     try:
         # Extract session and credentials
         session, api_id, api_hash = decode_session_with_credentials(session_string)
 
         # Create client with extracted credentials
-        client = TelegramClient(StringSession(session), api_id, api_hash)
+        client = PooledTelegramClient(
+            session_fingerprint(session_string), StringSession(session), api_id, api_hash
+        )
         await client.connect()
 
         if not await client.is_user_authorized():
@@ -27,8 +442,29 @@ async def get_client_from_session(session_string: str) -> TelegramClient:
         clients[session_string] = client
         return client
     except Exception as e:
+        if client is not None:
+            await safe_disconnect(client)
         raise HTTPException(status_code=401, detail="Invalid session")
 
+def session_fingerprint(session_string: str) -> str:
+    """Short stable identifier of a session that does not expose the session itself"""
+    return hashlib.sha256(session_string.encode('utf-8')).hexdigest()[:32]
+
+# WebSocket subprotocol "session.<base64url session string>" carries the session for browsers,
+# which can not set headers; unlike a query parameter it does not end up in access logs
+SESSION_SUBPROTOCOL_PREFIX = "session."
+
+def session_from_subprotocols(subprotocols) -> Optional[tuple[str, str]]:
+    """(subprotocol, session string) of the first session subprotocol offered, if any"""
+    for protocol in subprotocols:
+        if protocol.startswith(SESSION_SUBPROTOCOL_PREFIX):
+            encoded = protocol[len(SESSION_SUBPROTOCOL_PREFIX):]
+            try:
+                return protocol, base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4)).decode()
+            except ValueError:
+                return None
+    return None
+
 def encode_session_with_credentials(session: str, api_id: int, api_hash: str) -> str:
     """Combine session string with encrypted credentials"""
     encrypted_creds = encrypt_credentials(api_id, api_hash)
@@ -37,7 +473,8 @@ def encode_session_with_credentials(session: str, api_id: int, api_hash: str) ->
 def decode_session_with_credentials(combined_session: str) -> tuple[str, int, str]:
     """Extract session string and credentials"""
     try:
-        session, encrypted_creds = combined_session.split(':', 1)
+        # Sign-in sessions may end with a routing hint for the cluster, it is not part of the credentials
+        session, encrypted_creds = combined_session.split(':', 2)[:2]
         api_id, api_hash = decrypt_credentials(encrypted_creds)
         return session, api_id, api_hash
     except ValueError as e:
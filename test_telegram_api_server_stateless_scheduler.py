@@ -0,0 +1,34 @@
+import asyncio
+
+from telegram_api_server_stateless_scheduler import FairScheduler
+
+
+def test_waiter_cancelled_while_slot_is_released():
+    async def scenario():
+        scheduler = FairScheduler(1, 1, 0.5, {})
+        release_a = asyncio.Event()
+
+        async def call_a():
+            await release_a.wait()
+            # B is cancelled in the same tick A gives its slot back
+            task_b.cancel()
+            return "a"
+
+        task_a = asyncio.ensure_future(scheduler.run("A", call_a))
+        await asyncio.sleep(0)
+        task_b = asyncio.ensure_future(scheduler.run("B", lambda: asyncio.sleep(0)))
+        await asyncio.sleep(0)
+        release_a.set()
+
+        assert await task_a == "a"
+        await asyncio.gather(task_b, return_exceptions=True)
+        assert task_b.cancelled()
+        assert scheduler._active == {}
+        assert all(not cls.queued and not cls.queues for cls in scheduler._classes.values())
+
+        async def call_c():
+            return "c"
+
+        assert await asyncio.wait_for(scheduler.run("C", call_c), timeout=1) == "c"
+
+    asyncio.run(scenario())